@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# オフラインのベンチマーク。Discord も本物の Gemini も使わない。
+#
+#   python bench/bench.py e2e   [--prompts 5] [--record frames.jsonl] [--backend headless] [--marker-prompts 1]
+#       専用の tmux サーバー内で fake_gemini.py を起動し、TmuxGemini の ask 経路を
+#       記録用のフェイクチャンネルに対して実行する。--backend headless なら
+#       fake_gemini.py を stream-json モードのサブプロセスとして動かす。
+#       エンドツーエンドの遅延と Discord API 呼び出し回数を表示する。
+#   python bench/bench.py parse [--frames frames.jsonl]
+#       記録した（または合成した）ペインのキャプチャを、毎回の全解析
+#       (_extract_latest_responses) と ResponseParser の増分解析で再生し、スループットを比べる。
+#       キャプチャの範囲（500 行の履歴 + 画面）より長い回答を最後まで追えるかも確かめる。
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKE_GEMINI = os.path.join(HERE, "fake_gemini.py")
+sys.path.insert(0, os.path.dirname(HERE))
+
+
+class FakeMessage:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+        self.id = len(channel.calls)
+
+    async def edit(self, content=None, **kwargs):
+        self.channel.record("edit", content)
+        self.content = content
+        return self
+
+    async def delete(self):
+        self.channel.record("delete", self.content)
+
+
+class FakeChannel:
+    # send / edit を時刻つきで記録するだけのチャンネル
+    def __init__(self, channel_id=1):
+        self.id = channel_id
+        self.calls = []  # (time, kind, length)
+
+    def record(self, kind, content):
+        self.calls.append((time.perf_counter(), kind, len(content or "")))
+
+    def typing(self):
+        class _Typing:
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+        return _Typing()
+
+    async def send(self, content=None, **kwargs):
+        self.record("send", content)
+        return FakeMessage(self, content)
+
+    def count(self, kind, since=0.0):
+        return sum(1 for t, k, _ in self.calls if k == kind and t >= since)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_e2e(args):
+    # 手元の tmux を汚さないよう、専用のソケットディレクトリでサーバーを立てる
+    tmpdir = tempfile.mkdtemp(prefix="gemini-bench-")
+    os.environ["TMUX_TMPDIR"] = tmpdir
+    os.environ.pop("TMUX", None)
+    os.environ["WARM_POOL_SIZE"] = "0"
+    os.environ["GEMINI_BACKEND"] = args.backend
+    os.environ["GEMINI_EXECUTABLE_PATH"] = (
+        f"{sys.executable} {FAKE_GEMINI} --think {args.think} --delay {args.delay} "
+        f"--sections {args.sections} --lines {args.lines} --box-lines {args.box_lines}"
+    )
+    subprocess.run(["tmux", "new-session", "-d", "-s", "bench-keep", args.shell], check=True)
+    subprocess.run(["tmux", "set-option", "-g", "default-command", args.shell], check=True)
+    import main
+
+    record = open(args.record, "w") if args.record else None
+    try:
+        g = main.tmux_gemini
+        sess = g.get_session("bench:0")
+        t0 = time.perf_counter()
+        await g.ensure_active(sess.target)
+        cold = time.perf_counter() - t0
+
+        if record and args.backend == "tmux":
+            original = sess._capture
+
+            async def recording_capture(stream):
+                pane = await original(stream)
+                record.write(json.dumps({"t": time.perf_counter(), "pane": pane}) + "\n")
+                return pane
+            sess._capture = recording_capture
+
+        chan = FakeChannel()
+        latencies, first_sends = [], []
+        for i in range(args.prompts):
+            prompt = f"benchmark prompt number {i}"
+            if i >= args.prompts - args.marker_prompts:
+                # 回答の本文に考え中の案内と同じ文字が出ても、すぐ終わることを確認する
+                prompt += " - what does esc to cancel mean"
+            if record:
+                record.write(json.dumps({"prompt": prompt}) + "\n")
+            start = time.perf_counter()
+            await sess.submit(prompt, chan)
+            latencies.append(time.perf_counter() - start)
+            sends = [t for t, k, _ in chan.calls if k == "send" and t >= start]
+            if sends:
+                first_sends.append(sends[0] - start)
+    finally:
+        if record:
+            record.close()
+        subprocess.run(["tmux", "kill-server"], capture_output=True)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    expected = args.sections * (args.lines + (args.box_lines + 2 if args.box_lines else 0))
+    print(f"backend: {args.backend}")
+    print(f"cold start (ensure_active): {cold:.3f}s")
+    print(f"prompts: {args.prompts}  (~{expected} output lines each, {args.delay}s/line, think {args.think}s)")
+    print(f"end-to-end   p50 {percentile(latencies, 0.5):.3f}s  p95 {percentile(latencies, 0.95):.3f}s  max {max(latencies):.3f}s")
+    if first_sends:
+        print(f"first chunk  p50 {percentile(first_sends, 0.5):.3f}s  p95 {percentile(first_sends, 0.95):.3f}s")
+    print(f"discord calls: send {chan.count('send')}  edit {chan.count('edit')}  delete {chan.count('delete')}"
+          f"  ({len(chan.calls) / max(1, args.prompts):.1f} per prompt)")
+    print()
+    print(main.metrics.summary())
+
+
+CAPTURE_WINDOW = 500 + 100  # capture-pane -S -500 と画面の 100 行
+
+
+def synthetic_frames(args, sections=None, lines=None, box_lines=None):
+    # 長い回答と大きなツールログが少しずつ伸びていくペインを合成する
+    # (prompt, frames, 最後の画面をキャプチャの範囲で切らずに並べたもの) を返す
+    prompt = "synthetic benchmark prompt"
+    filler = ("lorem ipsum dolor sit amet " * 4)[:100]
+    body = []
+    for s in range(args.sections if sections is None else sections):
+        body.append(f"✦ Section {s + 1}")
+        body += [f"  {s}-{i:03d} {filler}" for i in range(args.lines if lines is None else lines)]
+        body.append("╭─ Shell step " + "─" * 90 + "╮")
+        body += ["│ " + f"{s}-{i:04d} {filler}"[:96].ljust(96) + " │" for i in range(args.box_lines if box_lines is None else box_lines)]
+        body.append("╰" + "─" * 104 + "╯")
+    history = [f"old history line {i}" for i in range(50)] + ["", "> " + prompt, ""]
+    footer = ["", "╭" + "─" * 60 + "╮", "│ > Type your message or @path/to/file" + " " * 23 + "│", "╰" + "─" * 60 + "╯"]
+    frames = []
+    for n in range(0, len(body) + 1, args.step):
+        spinner = "⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏"[n % 10] + " Thinking... (esc to cancel)"
+        screen = history + body[:n] + ["", spinner] + footer
+        frames.append("\n".join(screen[-CAPTURE_WINDOW:]) + "\n")
+    return prompt, frames, "\n".join(screen) + "\n"
+
+
+def load_frames(path):
+    # e2e --record で保存したファイル。最初のプロンプトの分だけ使う
+    prompt, frames = None, []
+    with open(path) as f:
+        for line in f:
+            item = json.loads(line)
+            if "prompt" in item:
+                if frames:
+                    break
+                prompt = item["prompt"]
+            elif prompt is not None:
+                frames.append(item["pane"])
+    return prompt, frames
+
+
+def run_parse(args):
+    import main
+    prompt, frames = load_frames(args.frames) if args.frames else synthetic_frames(args)[:2]
+    if not frames:
+        print("no frames to replay")
+        return
+    total_bytes = sum(len(f.encode()) for f in frames)
+    print(f"frames: {len(frames)}  ({total_bytes / 1e6:.2f} MB, {len(frames[-1].splitlines())} lines in the last one)")
+
+    g = main.tmux_gemini
+    results = {}
+    t0 = time.perf_counter()
+    for pane in frames:
+        full = g._extract_latest_responses(pane, prompt)
+    results["full re-parse"] = time.perf_counter() - t0
+
+    parser = main.ResponseParser(prompt)
+    t0 = time.perf_counter()
+    for pane in frames:
+        parser.feed(pane)
+    results["incremental"] = time.perf_counter() - t0
+
+    for name, elapsed in results.items():
+        print(f"{name:<14} {elapsed:.3f}s  {len(frames) / elapsed:9.1f} frames/s  {total_bytes / elapsed / 1e6:7.1f} MB/s")
+    print(f"speedup: {results['full re-parse'] / results['incremental']:.1f}x")
+    print(f"outputs match: {parser.responses == full}  ({len(full)} chunks)")
+
+    # _clean_output 単体（一番大きいチャンクを繰り返し掃除する）
+    chunk = max(frames[-1].split("╭"), key=len)
+    t0 = time.perf_counter()
+    for _ in range(args.clean_rounds):
+        g._clean_output(chunk, preserve_layout=True)
+    elapsed = time.perf_counter() - t0
+    print(f"_clean_output  {args.clean_rounds / elapsed:9.1f} calls/s on {len(chunk.splitlines())} lines")
+
+    # キャプチャの範囲より長い回答: プロンプト行が画面の上に流れ出ても、最後まで追えているか
+    prompt, frames, whole = synthetic_frames(args, sections=args.long_sections, lines=150, box_lines=100)
+    parser = main.ResponseParser(prompt)
+    t0 = time.perf_counter()
+    for pane in frames:
+        parser.feed(pane)
+    elapsed = time.perf_counter() - t0
+    expected = main.ResponseParser(prompt).feed_all(whole)
+    print(f"long answer    {len(whole.splitlines())} lines through a {CAPTURE_WINDOW}-line window, "
+          f"{len(frames) / elapsed:9.1f} frames/s")
+    print(f"long answer complete: {parser.responses == expected}  ({len(parser.responses)} / {len(expected)} chunks)")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Offline benchmarks for the Gemini Discord bridge")
+    sub = p.add_subparsers(dest="mode", required=True)
+
+    e2e = sub.add_parser("e2e", help="fake Gemini CLI in a real tmux server")
+    e2e.add_argument("--prompts", type=int, default=5)
+    e2e.add_argument("--think", type=float, default=0.5)
+    e2e.add_argument("--delay", type=float, default=0.02)
+    e2e.add_argument("--sections", type=int, default=3)
+    e2e.add_argument("--lines", type=int, default=8)
+    e2e.add_argument("--box-lines", type=int, default=20)
+    e2e.add_argument("--shell", default="/bin/sh", help="tmux ペインのシェル（起動の速いもの）")
+    e2e.add_argument("--record", help="キャプチャしたペインを JSON Lines で保存する（tmux のみ）")
+    e2e.add_argument("--backend", choices=["tmux", "headless"], default="tmux")
+    e2e.add_argument("--marker-prompts", type=int, default=1, help="最後の N 件は回答に \"esc to cancel\" が出るプロンプトにする")
+
+    parse = sub.add_parser("parse", help="replay pane captures through the parser")
+    parse.add_argument("--frames", help="e2e --record で保存したファイル（省略時は合成）")
+    parse.add_argument("--sections", type=int, default=4)
+    parse.add_argument("--lines", type=int, default=20)
+    parse.add_argument("--box-lines", type=int, default=90)
+    parse.add_argument("--step", type=int, default=3, help="合成フレーム 1 枚ごとに増える行数")
+    parse.add_argument("--clean-rounds", type=int, default=200)
+    parse.add_argument("--long-sections", type=int, default=6, help="キャプチャの範囲を超える長い回答のセクション数（1 つ 253 行）")
+
+    args = p.parse_args()
+    if args.mode == "e2e":
+        asyncio.run(run_e2e(args))
+    else:
+        run_parse(args)
+
+
+if __name__ == "__main__":
+    main()
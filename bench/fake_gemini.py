@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# ベンチマーク用の Gemini CLI の代役
+# bench.py が GEMINI_EXECUTABLE_PATH に指定して tmux の中で起動する。
+# 本物と同じく画面の一番下に「* Type your message」を出して入力を待ち、
+# ✦ セクション・罫線のツールログ・長い出力を指定した速さで流す。
+# --prompt と --output-format stream-json を付けると、本物のヘッドレスモードと同じ
+# JSON Lines のイベント（init / message / tool_use / tool_result / result）を出して終了する。
+import argparse
+import json
+import shutil
+import signal
+import sys
+import time
+import uuid
+
+PROMPT = "*   Type your message or @path/to/file "
+# 本物の CLI が考え中に出す案内。プロンプトに含まれていたら、回答の最後にそのまま書く
+BUSY_MARKERS = ("esc to cancel", "Press Ctrl+C")
+PASTE_START, PASTE_END = "\x1b[200~", "\x1b[201~"
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--y", action="store_true", help="本物の CLI と同じ引数を受け付けるだけ")
+    p.add_argument("--think", type=float, default=0.5, help="最初の出力までの秒数")
+    p.add_argument("--delay", type=float, default=0.02, help="1 行ごとの秒数")
+    p.add_argument("--sections", type=int, default=3, help="✦ セクションの数")
+    p.add_argument("--lines", type=int, default=8, help="セクションあたりの行数")
+    p.add_argument("--box-lines", type=int, default=20, help="ツールログ（罫線ボックス）の行数。0 でなし")
+    p.add_argument("--width", type=int, default=80, help="1 行の長さ")
+    p.add_argument("--no-spinner", action="store_true", help="考え中のスピナーを出さない")
+    p.add_argument("-p", "--prompt", help="ヘッドレスモード: このプロンプトに答えて終了する")
+    p.add_argument("--output-format", default="text", choices=["text", "json", "stream-json"])
+    p.add_argument("--resume", help="引き継ぐセッション ID")
+    return p.parse_args()
+
+
+def emit(line, delay):
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+    if delay:
+        time.sleep(delay)
+
+
+def show_prompt():
+    # 改行しないので、入力したテキストはプロンプト行にエコーされる
+    sys.stdout.write("\n" + PROMPT)
+    sys.stdout.flush()
+
+
+def read_prompts():
+    # ブラケットペーストの中の改行は 1 つのプロンプトとしてまとめる
+    pasted = None
+    for raw in sys.stdin:
+        if pasted is None and PASTE_START in raw:
+            pasted = []
+        if pasted is not None:
+            pasted.append(raw.replace(PASTE_START, "").replace(PASTE_END, ""))
+            if PASTE_END not in raw:
+                continue
+            raw, pasted = " ".join(pasted), None
+        yield "".join(c for c in raw if c.isprintable()).strip()
+
+
+def think(args):
+    # 本物と同じく、考えている間はスピナーを同じ行で回し、終わったら消す
+    if args.no_spinner:
+        time.sleep(args.think)
+        return
+    started = time.time()
+    frames = "⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏"
+    i = 0
+    while time.time() - started < args.think:
+        sys.stdout.write(f"\r{frames[i % 10]} Thinking... (esc to cancel, {int(time.time() - started)}s)")
+        sys.stdout.flush()
+        time.sleep(min(0.1, args.think))
+        i += 1
+    sys.stdout.write("\r\x1b[K")
+    sys.stdout.flush()
+
+
+def answer(prompt, args):
+    sys.stdout.write("\n")
+    think(args)
+    if prompt.startswith("/"):
+        # /help などはプレーンテキストで返す
+        for i in range(args.lines):
+            emit(f"  {prompt} usage line {i}", args.delay)
+        return
+    filler = ("lorem ipsum dolor sit amet " * (args.width // 27 + 1))[:args.width]
+    for s in range(args.sections):
+        emit(f"✦ Section {s + 1} for: {prompt[:40]}", args.delay)
+        for i in range(args.lines - 1):
+            emit(f"  {i:03d} {filler}", args.delay)
+        if "HANG" in prompt:
+            # ウォッチドッグの確認用: 途中で固まったふりをする
+            time.sleep(10 ** 6)
+        if args.box_lines and s < args.sections - 1:
+            inner = args.width + 6
+            emit("╭─ Shell run step " + str(s + 1) + " " + "─" * (inner - 18 - len(str(s + 1))) + "╮", args.delay)
+            for i in range(args.box_lines):
+                emit("│ " + f"{i:04d} {filler}"[:inner - 2].ljust(inner - 2) + " │", args.delay)
+            emit("╰" + "─" * inner + "╯", args.delay)
+    for marker in BUSY_MARKERS:
+        if marker in prompt:
+            # 完了判定の確認用: 案内と同じ文字が入力欄のすぐ上に残る
+            emit(f"✦ \"{marker}\" is the hint shown while I am thinking.", args.delay)
+    emit("✦ Done.", args.delay)
+
+
+def event(kind, **fields):
+    sys.stdout.write(json.dumps({"type": kind, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), **fields}) + "\n")
+    sys.stdout.flush()
+
+
+def answer_stream_json(prompt, args):
+    # answer() と同じ内容を、テキストはデルタ、ツールログは tool_use / tool_result として出す
+    started = time.time()
+    event("init", session_id=args.resume or str(uuid.uuid4()), model="fake-gemini")
+    event("message", role="user", content=prompt)
+    time.sleep(args.think)
+    filler = ("lorem ipsum dolor sit amet " * (args.width // 27 + 1))[:args.width]
+    tool_calls = 0
+    for s in range(args.sections):
+        event("message", role="assistant", content=f"Section {s + 1} for: {prompt[:40]}\n", delta=True)
+        for i in range(args.lines - 1):
+            time.sleep(args.delay)
+            event("message", role="assistant", content=f"  {i:03d} {filler}\n", delta=True)
+        if args.box_lines and s < args.sections - 1:
+            tool_id = f"run_shell_command-{s + 1}"
+            event("tool_use", tool_name="run_shell_command", tool_id=tool_id, parameters={"command": f"step {s + 1}"})
+            time.sleep(args.delay * args.box_lines)
+            output = "\n".join(f"{i:04d} {filler}" for i in range(args.box_lines))
+            event("tool_result", tool_id=tool_id, status="success", output=output)
+            tool_calls += 1
+    event("message", role="assistant", content="Done.", delta=True)
+    event("result", status="success", stats={"duration_ms": int((time.time() - started) * 1000), "tool_calls": tool_calls})
+
+
+def main():
+    args = parse_args()
+    if args.prompt is not None:
+        if args.output_format == "stream-json":
+            answer_stream_json(args.prompt, args)
+        else:
+            answer(args.prompt, args)
+        return
+    # C-c は入力のクリアに使われるので無視する
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # 画面を埋めて、プロンプトが常に一番下に来るようにする
+    sys.stdout.write("\n" * shutil.get_terminal_size().lines)
+    # 本物と同じくブラケットペーストを有効にする
+    sys.stdout.write("\x1b[?2004h")
+    show_prompt()
+    for prompt in read_prompts():
+        if prompt:
+            answer(prompt, args)
+        show_prompt()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,23 @@
 import discord
+import aiohttp
 from discord import app_commands
 from discord.ext import commands
 import os
 import asyncio
-import subprocess
 import re
 import hashlib
+import shlex
+import collections
+import json
+import bisect
+import time
+import uuid
+import shutil
+import gzip
+import io
+import sqlite3
+import threading
+from queue import SimpleQueue, Empty
 from dotenv import load_dotenv
 
 # Load environment
@@ -15,7 +27,68 @@ DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 DEFAULT_SESSION = os.getenv("TMUX_SESSION_NAME", "gemini-bot")
 GEMINI_CMD = os.getenv("GEMINI_EXECUTABLE_PATH", "gemini") + " --y"
 MY_DISCORD_ID = os.getenv("MY_DISCORD_ID")
+# チームで使う場合: MY_DISCORD_ID（管理者）に加えて使えるユーザー ID・ロール ID（カンマ区切り）
+ALLOWED_USER_IDS = {x.strip() for x in os.getenv("ALLOWED_USER_IDS", "").split(",") if x.strip()}
+ALLOWED_ROLE_IDS = {x.strip() for x in os.getenv("ALLOWED_ROLE_IDS", "").split(",") if x.strip()}
+# ユーザーごとの上限（管理者には適用しない）
+USER_MAX_INFLIGHT = int(os.getenv("USER_MAX_INFLIGHT", "2"))  # 処理中 + 順番待ちのプロンプト数
+USER_PROMPTS_PER_MINUTE = int(os.getenv("USER_PROMPTS_PER_MINUTE", "10"))
+USER_MAX_PROMPT_BYTES = int(os.getenv("USER_MAX_PROMPT_BYTES", "20000"))
+# 順番の重み（"ユーザーID:重み" をカンマ区切り、既定は 1）。重いほど多く順番が回ってくる
+USER_WEIGHTS = {k.strip(): float(v) for k, _, v in (x.partition(":") for x in os.getenv("USER_WEIGHTS", "").split(",")) if v.strip()}
 LAST_SESSION_FILE = os.path.join(os.path.dirname(__file__), '.last_session')
+CHANNEL_SESSIONS_FILE = os.path.join(os.path.dirname(__file__), '.channel_sessions.json')
+SESSION_BACKENDS_FILE = os.path.join(os.path.dirname(__file__), '.session_backends.json')
+COMMAND_TREE_FILE = os.path.join(os.path.dirname(__file__), '.command_tree_hash')
+SYNC_GUILD_ID = os.getenv("SYNC_GUILD_ID")  # 指定するとこのサーバーにだけ同期する（反映が即時）
+# やり取りの記録（SQLite）。空にすると記録しない
+TRANSCRIPT_DB = os.getenv("TRANSCRIPT_DB", "transcripts.db")
+if TRANSCRIPT_DB:  # 相対パスはボットのディレクトリから
+    TRANSCRIPT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), TRANSCRIPT_DB)
+TRANSCRIPT_FLUSH = float(os.getenv("TRANSCRIPT_FLUSH", "0.5"))  # 書き込みをまとめる間隔（秒）
+# 応答の取り方: tmux（画面を読み取る）か headless（gemini -p の stream-json を直接読む）。/backend でセッションごとに切り替えられる
+GEMINI_BACKEND = os.getenv("GEMINI_BACKEND", "tmux")
+GEMINI_HEADLESS_CMD = os.getenv("GEMINI_HEADLESS_CMD") or GEMINI_CMD + " --output-format stream-json"
+GEMINI_HEADLESS_CWD = os.getenv("GEMINI_HEADLESS_CWD") or os.path.dirname(os.path.abspath(__file__))
+HEADLESS_RESUME = os.getenv("HEADLESS_RESUME", "1") == "1"  # 前回の会話を --resume で引き継ぐ
+# ストリーミング設定（秒）
+STREAM_MIN_INTERVAL = float(os.getenv("STREAM_MIN_INTERVAL", "0.25"))  # capture の最小間隔
+STREAM_IDLE_TICK = float(os.getenv("STREAM_IDLE_TICK", "1.0"))  # 出力がなくても状態を再評価する間隔
+RESPONSE_TIMEOUT = float(os.getenv("RESPONSE_TIMEOUT", "400"))
+# 完了判定: スピナーもプロンプトも見えないときは、学習した出力間隔から決めた時間だけ静かなら完了（この範囲に収める）
+QUIET_MIN = float(os.getenv("QUIET_MIN", "10"))
+QUIET_MAX = float(os.getenv("QUIET_MAX", "80"))
+# ウォッチドッグ: 応答中にこの秒数まったく画面が動かない、または Gemini が落ちていたら再起動する
+WATCHDOG_INTERVAL = float(os.getenv("WATCHDOG_INTERVAL", "15"))
+HUNG_TIMEOUT = float(os.getenv("HUNG_TIMEOUT", "180"))
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT", "30"))  # Gemini 起動を待つ上限
+INPUT_TIMEOUT = float(os.getenv("INPUT_TIMEOUT", "3"))  # 入力欄のクリア・エコーを待つ上限
+PASTE_THRESHOLD = int(os.getenv("PASTE_THRESHOLD", "200"))  # これより長い（または複数行の）プロンプトは paste-buffer で送る
+# 起動済み Gemini ペインのプール
+WARM_POOL_SIZE = int(os.getenv("WARM_POOL_SIZE", "1"))
+WARM_POOL_PREFIX = os.getenv("WARM_POOL_PREFIX", "gemini-warm-")
+WARM_POOL_CHECK = float(os.getenv("WARM_POOL_CHECK", "30"))  # 落ちたペインを確認する間隔
+THREAD_SESSIONS = os.getenv("THREAD_SESSIONS", "0") == "1"  # 新しいスレッドごとに専用セッションを割り当てる
+# プロンプトの順番待ち
+QUEUE_MAX = int(os.getenv("QUEUE_MAX", "5"))  # セッションごとの順番待ちの上限
+MERGE_WINDOW = float(os.getenv("MERGE_WINDOW", "0"))  # この秒数以内の連投を 1 つのプロンプトにまとめる（0 で無効）
+# Discord の添付ファイルを Gemini の作業ディレクトリに保存して @file で渡す
+ATTACHMENT_DIR = os.getenv("ATTACHMENT_DIR", ".discord-attachments")  # Gemini の作業ディレクトリからの相対パス
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(25 * 1024 * 1024)))  # 1 ファイルの上限
+ATTACHMENT_BUDGET_BYTES = int(os.getenv("ATTACHMENT_BUDGET_BYTES", str(50 * 1024 * 1024)))  # 1 メッセージの合計の上限
+ATTACHMENT_CONCURRENCY = int(os.getenv("ATTACHMENT_CONCURRENCY", "4"))
+# Prometheus 形式のメトリクスを返すローカル HTTP（ポート未設定なら起動しない）
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.getenv("METRICS_PORT")
+# tmux コマンド設定
+TMUX_TIMEOUT = float(os.getenv("TMUX_TIMEOUT", "10"))  # 1 コマンドあたりの上限（秒）
+TMUX_MAX_CONCURRENCY = int(os.getenv("TMUX_MAX_CONCURRENCY", "8"))  # 同時に起動する tmux プロセス数の上限
+# Discord 送信・編集のレート（チャンネルごとのトークンバケット）
+EDIT_RATE = float(os.getenv("EDIT_RATE", "1.0"))  # 1 秒あたりに補充されるトークン
+EDIT_BURST = float(os.getenv("EDIT_BURST", "5"))  # バケットの容量
+# これより長いツールログは末尾だけ表示し、全体は圧縮して添付する
+LOG_FOLD_CHARS = int(os.getenv("LOG_FOLD_CHARS", "1800"))
+LOG_PREVIEW_LINES = int(os.getenv("LOG_PREVIEW_LINES", "8"))
 
 # Setup Intents
 intents = discord.Intents.default()
@@ -23,12 +96,2028 @@ intents.messages = True
 intents.message_content = True
 intents.dm_messages = True
 
-class TmuxGemini:
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
     def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # 最後は +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # バケットの上限で近似した分位点
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.BUCKETS[i], self.max) if i < len(self.BUCKETS) else self.max
+        return self.max
+
+
+class _Timer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.metrics.observe(self.name, self.elapsed)
+
+
+class Metrics:
+    # プロセス内のヒストグラムとカウンタ。/metrics と Prometheus 形式の HTTP で公開する
+    def __init__(self):
+        self.histograms = {}
+        self.counters = collections.Counter()  # (name, labels) -> value
+        self.collectors = []  # 他で数えている値を (name, labels, value) で返す関数
+        self.server = None
+
+    def observe(self, name, seconds):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].observe(seconds)
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def inc(self, name, labels="", n=1):
+        self.counters[(name, labels)] += n
+
+    def _all_counters(self):
+        items = list(self.counters.items())
+        for collect in self.collectors:
+            items += [((name, labels), value) for name, labels, value in collect()]
+        return sorted(items)
+
+    def summary(self):
+        lines = [f"{'name':<34} {'count':>6} {'p50':>7} {'p95':>7} {'max':>7}"]
+        for name, h in sorted(self.histograms.items()):
+            lines.append(f"{name:<34} {h.count:>6} {h.quantile(0.5):>7.3f} {h.quantile(0.95):>7.3f} {h.max:>7.3f}")
+        for (name, labels), value in self._all_counters():
+            lines.append(f"{name + ('{' + labels + '}' if labels else ''):<34} {value:>6}")
+        return "\n".join(lines)
+
+    def render_prometheus(self):
+        out = []
+        for name, h in sorted(self.histograms.items()):
+            out.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, n in zip(Histogram.BUCKETS + ("+Inf",), h.counts):
+                cumulative += n
+                out.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            out.append(f"{name}_sum {h.sum}")
+            out.append(f"{name}_count {h.count}")
+        typed = set()
+        for (name, labels), value in self._all_counters():
+            if name not in typed:
+                out.append(f"# TYPE {name} counter")
+                typed.add(name)
+            out.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        return "\n".join(out) + "\n"
+
+    async def serve(self, host, port):
+        # 依存を増やさないよう、GET に Prometheus テキストを返すだけの最小 HTTP
+        async def handle(reader, writer):
+            try:
+                await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+                body = self.render_prometheus().encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                             + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+                await writer.drain()
+            except Exception:
+                pass
+            finally:
+                writer.close()
+        self.server = await asyncio.start_server(handle, host, int(port))
+        print(f"INFO: Metrics listening on http://{host}:{port}/metrics")
+
+
+metrics = Metrics()
+
+
+class TmuxResult(collections.namedtuple("TmuxResult", "args returncode stdout stderr timed_out")):
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+
+class TmuxClient:
+    # asyncio.create_subprocess_exec ベースの tmux クライアント
+    # イベントループ（= Gateway のハートビート）を止めないよう、全ての tmux 呼び出しはここを通す
+    def __init__(self, max_concurrency=TMUX_MAX_CONCURRENCY, timeout=TMUX_TIMEOUT):
+        self.timeout = timeout
+        self._sem = asyncio.Semaphore(max_concurrency)
+
+    async def run(self, *args, input=None, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        async with self._sem:
+            metrics.inc("tmux_commands_total")
+            started = time.perf_counter()
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    "tmux", *args,
+                    stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+            except OSError as e:
+                print(f"DEBUG: Failed to run tmux {args[:1]}: {e}")
+                return TmuxResult(args, -1, "", str(e), False)
+            try:
+                out, err = await asyncio.wait_for(proc.communicate(input), timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                metrics.inc("tmux_timeouts_total")
+                print(f"DEBUG: tmux {args[0]} timed out after {timeout}s")
+                return TmuxResult(args, proc.returncode, "", "", True)
+            metrics.observe("tmux_command_seconds", time.perf_counter() - started)
+        return TmuxResult(args, proc.returncode, out.decode(errors='ignore'), err.decode(errors='ignore'), False)
+
+    async def output(self, *args, **kwargs):
+        # 標準出力だけがほしいとき。失敗時は空文字
+        res = await self.run(*args, **kwargs)
+        return res.stdout if res.ok else ""
+
+    async def has_session(self, target):
+        return (await self.run("has-session", "-t", target)).ok
+
+    async def new_session(self, name, window_name="gemini-chat"):
+        return await self.run("new-session", "-d", "-s", name, "-n", window_name)
+
+    async def kill_session(self, name):
+        return await self.run("kill-session", "-t", name)
+
+    async def send_keys(self, target, *keys, literal=False):
+        args = ["send-keys", "-t", target] + (["-l"] if literal else []) + list(keys)
+        return await self.run(*args)
+
+    async def list_sessions(self):
+        return await self.run("ls")
+
+    async def load_buffer(self, name, data):
+        # stdin から読ませるので、長さやエスケープを気にしなくてよい
+        return await self.run("load-buffer", "-b", name, "-", input=data.encode())
+
+    async def paste_buffer(self, name, target):
+        # -p: ブラケットペースト（改行で途中送信されない） / -d: 貼り付け後にバッファを消す
+        return await self.run("paste-buffer", "-b", name, "-t", target, "-p", "-d")
+
+
+class TmuxControlStream:
+    # tmux -C（コントロールモード）の常駐接続
+    # %output 通知でペインの更新を即座に受け取り、capture-pane も同じ接続で流すので fork しない
+    def __init__(self, session):
+        self.session = session
+        self.proc = None
+        self.alive = False
+        self._pending = collections.deque()  # コマンド応答待ちの Future（tmux は送信順に応答する）
+        self._events = {}  # pane_id -> asyncio.Event
+        self._reader_task = None
+
+    async def start(self):
+        try:
+            self.proc = await asyncio.create_subprocess_exec(
+                "tmux", "-C", "attach-session", "-t", self.session,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+                limit=4 * 1024 * 1024,
+            )
+        except Exception as e:
+            print(f"DEBUG: Failed to start control mode for {self.session}: {e}")
+            return False
+        self.alive = True
+        self._reader_task = asyncio.create_task(self._read_loop())
+        return True
+
+    async def _read_loop(self):
+        block = None  # 自分が送ったコマンドの応答行
+        in_block = False
+        try:
+            while True:
+                raw = await self.proc.stdout.readline()
+                if not raw:
+                    break
+                line = raw.decode(errors='ignore').rstrip("\n")
+                if in_block:
+                    if line.startswith(("%end ", "%error ")):
+                        in_block = False
+                        if block is not None and self._pending:
+                            fut = self._pending.popleft()
+                            if not fut.done():
+                                fut.set_result((line.startswith("%end "), block))
+                        block = None
+                    else:
+                        if block is not None:
+                            block.append(line)
+                    continue
+                if line.startswith("%begin "):
+                    in_block = True
+                    # flags == 1 のブロックだけがこのクライアントのコマンドへの応答（attach 時の分は除外）
+                    block = [] if line.split()[-1] == "1" else None
+                elif line.startswith(("%output ", "%extended-output ")):
+                    pane_id = line.split(" ", 2)[1]
+                    ev = self._events.get(pane_id)
+                    if ev:
+                        ev.set()
+                elif line.startswith("%exit"):
+                    break
+        except Exception as e:
+            print(f"DEBUG: Control mode reader for {self.session} stopped: {e}")
+        finally:
+            self.alive = False
+            while self._pending:
+                fut = self._pending.popleft()
+                if not fut.done():
+                    fut.set_result((False, []))
+            # 待っている人を起こして、フォールバックに切り替えてもらう
+            for ev in self._events.values():
+                ev.set()
+
+    async def command(self, args, timeout=5.0):
+        if not self.alive:
+            return False, []
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append(fut)
+        try:
+            self.proc.stdin.write((" ".join(shlex.quote(a) for a in args) + "\n").encode())
+            await self.proc.stdin.drain()
+            return await asyncio.wait_for(asyncio.shield(fut), timeout)
+        except Exception:
+            return False, []
+
+    async def wait_for_output(self, pane_id, timeout):
+        ev = self._events.setdefault(pane_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(ev.wait(), timeout)
+            got = True
+        except asyncio.TimeoutError:
+            got = False
+        ev.clear()
+        return got
+
+    async def close(self):
+        if self.proc and self.proc.returncode is None:
+            try:
+                self.proc.stdin.close()
+                await asyncio.wait_for(self.proc.wait(), 2)
+            except Exception:
+                self.proc.kill()
+        self.alive = False
+
+
+# UI ornaments and box characters to strip
+ANSI_RE = re.compile(r'\x1b\[[0-9;]*[mK]')
+BOX_CHARS = "─│┌┐└┘├┤┬┴┼═║╔╗╚╝╠╣╦╩╬╭╮╯╰"
+BOX_SET = frozenset(BOX_CHARS)
+BOX_TABLE = str.maketrans("", "", BOX_CHARS)
+BOX_STARTS = ("┌", "╭", "╔")
+UI_BARS = ("▀▀", "▄▄", "███", "░░░", "Type your message", "shortcuts", "skills")
+CLEAN_IGNORE = ("Type your message", "Press Ctrl+C", "no sandbox", "Update available", "shortcuts", "YOLO", "skills", "file |", "▀▀", "▄▄", "███", "░░░")
+
+
+def strip_ansi(line):
+    # capture-pane は -e なしだとエスケープを含まないので、大抵は正規表現まで行かない
+    return ANSI_RE.sub('', line) if "\x1b" in line else line
+
+
+def clean_line(line, preserve_layout=False):
+    # 1 行分の _clean_output。表示しない行は None
+    if any(p in line for p in CLEAN_IGNORE):
+        return None
+    # 🚨 枠線（罫線）を徹底的に消す！（丸い角 ╭╮╯╰ も含む）
+    line = strip_ansi(line).translate(BOX_TABLE)
+    # ログモードの時は、右側の空白だけ消してインデントは守る
+    line = line.rstrip() if preserve_layout else line.strip()
+    return line if line.strip() else None
+
+
+def clean_lines(lines, preserve_layout=False):
+    return "\n".join(c for c in (clean_line(l, preserve_layout) for l in lines) if c is not None).strip()
+
+
+class _Chunk:
+    # 解析中のセクション（✦ の回答 or 罫線ボックスのログ）
+    __slots__ = ("start", "log", "sparkle", "rels", "cleaned", "text")
+
+    def __init__(self, start, log, sparkle=False):
+        self.start = start  # アンカー後の最初の出力行からの相対行番号
+        self.log = log
+        self.sparkle = sparkle
+        self.rels = []
+        self.cleaned = []  # 行ごとの clean_line 済みの結果（再計算しない）
+        self.text = None  # レンダリング結果のキャッシュ
+
+    def add(self, rel, line):
+        self.rels.append(rel)
+        self.cleaned.append(clean_line(line, self.log))
+        self.text = None
+
+    def truncate(self, rel):
+        cut = bisect.bisect_left(self.rels, rel)
+        del self.rels[cut:], self.cleaned[cut:]
+        self.text = None
+
+    def render(self, is_last):
+        clean = "\n".join(c for c in self.cleaned if c is not None).strip()
+        if not clean:
+            return ""
+        if self.log:
+            return "```\n" + clean + "\n```"
+        # ✦ で始まらないプレーンテキスト（/helpなど）が最後に来た場合は、コードブロックで囲うと見やすい
+        if is_last and not self.sparkle:
+            return "```\n" + clean + "\n```"
+        return "✦ " + clean
+
+
+class ResponseParser:
+    # ask 1 回分のストリーミング解析器
+    # アンカー（プロンプト行）と前回のキャプチャを覚えておき、変化した行以降だけを解析し直す
+    def __init__(self, user_input):
+        lines = user_input.splitlines()
+        # 🚨 ユーザーの入力をより確実にスキップする
+        self.search_term = lines[0][:15] if lines else user_input[:15]
+        self.prev = []
+        self.anchor = None  # プロンプト行の位置（画面の上に流れ出たら負になる）
+        self.anchor_line = None
+        self.start = None  # アンカー後の最初の出力行（✦ or 罫線）の位置（同上）
+        self.chunks = []
+        self.responses = []
+
+    def feed_all(self, pane_text):
+        self.feed(pane_text)
+        return list(self.responses)
+
+    def feed(self, pane_text):
+        # 新しいキャプチャを取り込み、変わったチャンクを [(index, text, is_log)] で返す
+        parts = pane_text.splitlines()
+        prev = self._align(parts)
+        n = min(len(parts), len(prev))
+        d = 0
+        while d < n and parts[d] == prev[d]:
+            d += 1
+        self.prev = parts
+        if d == len(parts) == len(prev):
+            return []
+
+        # 変化した範囲だけ、新しいプロンプト行が出ていないか後ろから探す
+        if self.anchor is None or d <= self.anchor:
+            anchor = self._find_anchor(parts, 0)
+        else:
+            anchor = self._find_anchor(parts, d)
+            if anchor is None:
+                anchor = self.anchor
+        if anchor != self.anchor or self.anchor is None:
+            self.anchor = anchor
+            self.anchor_line = parts[anchor] if anchor is not None else None
+            self.start = None
+            self.chunks = []
+        if self.anchor is None:
+            return self._publish()
+
+        if self.start is None or d <= self.start:
+            # プロンプト自体の続きをスキップし、最初の出力を探す
+            self.start = None
+            self.chunks = []
+            for j in range(max(0, self.anchor + 1), len(parts)):
+                clean_j = strip_ansi(parts[j])
+                if "✦" in clean_j or not BOX_SET.isdisjoint(clean_j):
+                    self.start = j
+                    break
+            if self.start is None:
+                return self._publish()
+            d = self.start
+        self._parse(parts, d - self.start)
+        return self._publish()
+
+    def _align(self, parts):
+        # 履歴がスクロールして行がずれた場合は、アンカー行を手がかりに前回のキャプチャをずらす
+        prev = self.prev
+        if self.anchor is None or (0 <= self.anchor < len(parts) and parts[self.anchor] == self.anchor_line):
+            return prev
+        for k in range(min(self.anchor, len(parts)) - 1, -1, -1):
+            if parts[k] == self.anchor_line:
+                return self._shift(self.anchor - k)
+        # アンカーがキャプチャの範囲より上に流れ出た（長い回答）。前回との重なりからずれを求め、
+        # 解析済みのチャンクはそのまま残す
+        shift = self._overlap(prev, parts)
+        if shift is None:
+            self.anchor = None
+            return []
+        return self._shift(shift)
+
+    def _shift(self, shift):
+        self.anchor -= shift
+        if self.start is not None:
+            self.start -= shift
+        return self.prev[shift:]
+
+    @staticmethod
+    def _overlap(prev, parts, slack=8):
+        # 前回のキャプチャが何行上にずれたか。一番下の数行（スピナーや伸びている行）は比べない
+        for k in range(len(prev)):
+            w = min(len(prev) - k, len(parts)) - slack
+            if w < 1:
+                return None
+            if prev[k] == parts[0] and prev[k:k + w] == parts[:w]:
+                return k
+        return None
+
+    def _find_anchor(self, parts, lo):
+        # 後ろからスキャンして、最新の（一番下にある）ユーザー入力を探す
+        for idx in range(len(parts) - 1, lo - 1, -1):
+            clean_l = strip_ansi(parts[idx])
+            if self.search_term in clean_l:
+                stripped = clean_l.strip()
+                if stripped.startswith((">", "*")) or ("> " + self.search_term in clean_l):
+                    return idx
+        return None
+
+    def _parse(self, parts, rel):
+        # rel 行目の直前の状態まで巻き戻し、そこから先だけ解析する
+        while self.chunks and self.chunks[-1].start >= rel:
+            self.chunks.pop()
+        cur = self.chunks[-1] if self.chunks else None
+        if cur:
+            cur.truncate(rel)
+        is_log_mode = cur.log if cur else False
+
+        for r in range(rel, len(parts) - self.start):
+            clean_line = strip_ansi(parts[self.start + r])
+            if any(bar in clean_line for bar in UI_BARS): continue
+
+            stripped_line = clean_line.lstrip()
+            # 1. 新しい ✦ セクションが「行の先頭で」始まった場合
+            if stripped_line.startswith("✦"):
+                cur = _Chunk(r, log=False, sparkle=True)
+                cur.add(r, clean_line[clean_line.find("✦") + 1:])
+            # 2. 新しいボックスが「行の先頭で」始まった場合
+            elif stripped_line.startswith(BOX_STARTS):
+                cur = _Chunk(r, log=True)
+                cur.add(r, clean_line)
+            # 3. ボックス（ログ）継続判定
+            elif not BOX_SET.isdisjoint(clean_line):
+                if is_log_mode and cur:
+                    cur.add(r, clean_line)
+                    continue
+                cur = _Chunk(r, log=True)
+                cur.add(r, clean_line)
+            # 4. ボックスの終了判定（ログモード中に罫線がない行が来たら、即座にログを閉じる）
+            elif is_log_mode or cur is None:
+                cur = _Chunk(r, log=False)
+                cur.add(r, clean_line)
+            # 5. 通常のテキスト
+            else:
+                cur.add(r, clean_line)
+                continue
+            self.chunks.append(cur)
+            is_log_mode = cur.log
+
+    def _publish(self):
+        res = []
+        logs = []  # 罫線ボックスのツールログか（最後のプレーンテキストもコードブロックになるので、見た目では判断しない）
+        last = len(self.chunks) - 1
+        for i, chunk in enumerate(self.chunks):
+            if i == last:
+                text = chunk.render(True)
+            else:
+                if chunk.text is None:
+                    chunk.text = chunk.render(False)
+                text = chunk.text
+            if text.strip():
+                res.append(text)
+                logs.append(chunk.log)
+        changes = [(i, r, logs[i]) for i, r in enumerate(res) if i >= len(self.responses) or self.responses[i] != r]
+        self.responses = res
+        return changes
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
         self.lock = asyncio.Lock()
-        self.sent_messages_hashes = set()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # トークンが無ければ補充されるまで待つ。待った場合は True
+        async with self.lock:
+            self._refill()
+            waited = False
+            if self.tokens < 1:
+                waited = True
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+            return waited
+
+    def penalize(self, seconds):
+        # 429 を受けたら、その分だけバケットを空にしておく
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+PAGE_LIMIT = 2000  # Discord の 1 メッセージの上限
+
+
+def paginate(text, limit=PAGE_LIMIT):
+    # 行の境目でページに分ける。コードブロックの途中で切れる場合は、ページ末で閉じて次のページで開き直す
+    pages = []
+    page = []
+    fence = None  # 開いているコードブロックの開始行（```python など）
+
+    def length(extra):
+        # extra を足した後のページの長さ（開いているブロックを閉じる ``` も含む）
+        return len("\n".join(page + [extra])) + (4 if fence else 0)
+
+    def flush():
+        nonlocal page
+        pages.append("\n".join(page + (["```"] if fence else [])))
+        page = [fence] if fence else []
+
+    for line in text.split("\n"):
+        is_fence = line.strip().startswith("```")
+        opens = is_fence and not fence  # 開く行なら、閉じる ``` の分も空けておく
+        if page and length(line) + (4 if opens else 0) > limit:
+            if is_fence and fence:
+                # 閉じるだけの行なら、ページ末で閉じれば済む
+                flush()
+                page = []
+                fence = None
+                continue
+            flush()
+        # 1 行だけで上限を超える場合は文字数で切る
+        while length(line) > limit:
+            room = limit - length("") - (1 if page else 0)
+            page.append(line[:room])
+            line = line[room:]
+            flush()
+        page.append(line)
+        if is_fence:
+            fence = None if fence else line.strip()
+    if any(l.strip() for l in page if l != fence):
+        flush()
+    return [p for p in pages if p.strip()] or [""]
+
+
+class ChannelOutbox:
+    # ask 1 回分のメッセージ群。update() は即座に戻り、実際の送信・編集は裏のタスクが行う
+    # チャンクはページ（= メッセージ）に分けて並べ、内容が変わったページだけを送信・編集する
+    # 同じメッセージへの更新は最新の内容だけが送られ、新しいページの送信が編集より優先される
+    def __init__(self, scheduler, channel):
+        self.scheduler = scheduler
+        self.channel = channel
+        self.bucket = scheduler.bucket_for(channel)
+        self.handles = []  # 送信済み Message（送信に失敗した場合は None）
+        self.sent = []  # 送信済みの内容
+        self.pending = {}  # ページ番号 -> 最新の内容（None なら削除）
+        self.chunks = {}  # チャンク番号 -> (内容, ツールログか)
+        self.files = {}  # ページ番号 -> (チャンク番号, ファイル名, 中身)。次の送信・編集で添付する
+        self.attached = set()  # 添付済みのチャンク番号
+        self._pages = {}  # チャンク番号 -> (内容, 確定済みか, ページ, 添付)
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.task = None
+        self.on_sent = None  # 送信・編集できたら (ページ番号, content, message) で呼ばれる
+
+    def update(self, idx, content, log=False):
+        self.chunks[idx] = (content, log)
+        self._repaginate()
+
+    def truncate(self, count):
+        # 解析し直してチャンクが減ったら（count 番目以降がなくなったら）、そのページも消す
+        # 0 件は解析が一時的に見失っただけなので、送った内容は残しておく
+        stale = [idx for idx in self.chunks if idx >= count] if count else []
+        if not stale:
+            return
+        for idx in stale:
+            del self.chunks[idx]
+            self._pages.pop(idx, None)
+        self._repaginate()
+
+    def _chunk_pages(self, idx):
+        content, log = self.chunks[idx]
+        final = self.closed or idx < max(self.chunks)
+        cached = self._pages.get(idx)
+        if cached and cached[0] == content and cached[1] == final:
+            return cached[2], cached[3]
+        if log and len(content) > LOG_FOLD_CHARS:
+            pages, file = self._fold(idx, content, final)
+        else:
+            pages, file = paginate(content), None
+        self._pages[idx] = (content, final, pages, file)
+        return pages, file
+
+    def _fold(self, idx, content, final):
+        # 大きなツールログは末尾だけ見せて、確定したら全体を圧縮して添付する
+        body = content.strip().strip("`").strip("\n").split("\n")
+        tail = "\n".join(l[:200] for l in body[-LOG_PREVIEW_LINES:])
+        if not final:
+            return [f"```\n{tail}\n```\n📜 ツールログ {len(body)} 行（実行中…）"], None
+        name = f"tool-log-{idx + 1}.txt.gz"
+        return [f"```\n{tail}\n```\n📎 ツールログ全体（{len(body)} 行）は `{name}` にあるよ"], (name, gzip.compress("\n".join(body).encode()))
+
+    def _repaginate(self):
+        stats = self.scheduler.stats
+        flat = []
+        self.files = {}
+        for idx in sorted(self.chunks):
+            pages, file = self._chunk_pages(idx)
+            if file and idx not in self.attached:
+                self.files[len(flat)] = (idx,) + file
+            flat += pages
+        for i, page in enumerate(flat):
+            if i < len(self.sent) and self.sent[i] == page and i not in self.files:
+                self.pending.pop(i, None)
+                continue
+            if i in self.pending:
+                stats["coalesced"] += 1
+            self.pending[i] = page
+        # 前のチャンクが縮んでページが減ったら、余ったメッセージを消す
+        for i in range(len(flat), len(self.handles)):
+            self.pending[i] = None
+        for i in [i for i in self.pending if i >= max(len(flat), len(self.handles))]:
+            del self.pending[i]
+        self.wakeup.set()
+        if self.task is None:
+            self.task = asyncio.create_task(self._drain())
+
+    def _next(self):
+        deletions = [i for i, c in self.pending.items() if c is None]
+        if deletions:
+            return max(deletions)
+        if len(self.handles) in self.pending:
+            return len(self.handles)
+        edits = [i for i in self.pending if i < len(self.handles)]
+        return min(edits) if edits else None
+
+    async def _drain(self):
+        stats = self.scheduler.stats
+        while True:
+            idx = self._next()
+            if idx is None:
+                if self.closed:
+                    return
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            if await self.bucket.acquire():
+                stats["throttled"] += 1
+            if idx not in self.pending:
+                continue
+            # 待っている間に届いた更新も含めて、最新の内容を送る
+            content = self.pending.pop(idx)
+            attachment = self.files.get(idx)
+            kwargs = {}
+            if attachment:
+                kwargs["file" if idx == len(self.handles) else "attachments"] = (
+                    discord.File(io.BytesIO(attachment[2]), filename=attachment[1]))
+                if idx < len(self.handles):
+                    kwargs["attachments"] = [kwargs["attachments"]]
+            try:
+                if content is None:
+                    if self.handles[idx] is not None:
+                        await self.handles[idx].delete()
+                    stats["deleted"] += 1
+                    if idx == len(self.handles) - 1:
+                        self.handles.pop()
+                        self.sent.pop()
+                    continue
+                if idx == len(self.handles):
+                    with metrics.timer("discord_send_seconds"):
+                        self.handles.append(await self.channel.send(content, **kwargs))
+                    self.sent.append(content)
+                    stats["sent"] += 1
+                elif self.handles[idx] is not None:
+                    with metrics.timer("discord_edit_seconds"):
+                        await self.handles[idx].edit(content=content, **kwargs)
+                    self.sent[idx] = content
+                    stats["edits"] += 1
+                else:
+                    continue
+                if attachment:
+                    self.attached.add(attachment[0])
+                    self.files.pop(idx, None)
+                    stats["attachments"] += 1
+                if self.on_sent:
+                    self.on_sent(idx, content, self.handles[idx])
+            except Exception as e:
+                if isinstance(e, discord.HTTPException) and e.status == 429:
+                    stats["rate_limited"] += 1
+                    self.bucket.penalize(getattr(e, "retry_after", None) or 1.0)
+                    self.pending.setdefault(idx, content)
+                    continue
+                # 削除されていた場合など
+                stats["failed"] += 1
+                print(f"DEBUG: Discord {'send' if idx == len(self.handles) else 'edit'} failed for page {idx}: {e}")
+                if content is None:
+                    if idx == len(self.handles) - 1:
+                        self.handles.pop()
+                        self.sent.pop()
+                elif idx == len(self.handles):
+                    # 番号をずらさないよう、送れなかったメッセージも枠だけ確保する
+                    self.handles.append(None)
+                    self.sent.append(content)
+
+    async def close(self):
+        # 残っている更新（確定したツールログの添付も）を全て流し切る
+        self.closed = True
+        if self.chunks:
+            self._repaginate()
+        self.wakeup.set()
+        if self.task:
+            await self.task
+
+
+class EditScheduler:
+    def __init__(self, rate=EDIT_RATE, burst=EDIT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # channel_id -> TokenBucket
+        self.stats = collections.Counter()
+
+    def bucket_for(self, channel):
+        if channel.id not in self.buckets:
+            self.buckets[channel.id] = TokenBucket(self.rate, self.burst)
+        return self.buckets[channel.id]
+
+    def open(self, channel):
+        return ChannelOutbox(self, channel)
+
+    def summary(self):
+        s = self.stats
+        return (f"送信 {s['sent']} / 編集 {s['edits']} / 間引き {s['coalesced']} / 添付 {s['attachments']} / "
+                f"待機 {s['throttled']} / 429 {s['rate_limited']} / 失敗 {s['failed']}")
+
+
+class AttachmentIngestor:
+    # 添付ファイルを並行してチャンクごとにディスクへ流し込み、内容のハッシュで重複を除く
+    CHUNK = 64 * 1024
+
+    def __init__(self, max_bytes=ATTACHMENT_MAX_BYTES, budget=ATTACHMENT_BUDGET_BYTES, concurrency=ATTACHMENT_CONCURRENCY):
+        self.max_bytes = max_bytes
+        self.budget = budget
+        self._sem = asyncio.Semaphore(concurrency)
+        self._http = None
+
+    async def _session(self):
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300))
+        return self._http
+
+    @staticmethod
+    def _safe_name(name):
+        # @file で参照しやすいよう、空白や記号を含まない名前にする
+        base = re.sub(r'[^A-Za-z0-9._-]+', '_', name).strip("._") or "file"
+        return base[-80:]
+
+    async def workdir(self, session):
+        # Gemini が動いているディレクトリの下にセッションごとの置き場を作る
+        cwd = await session.backend.cwd()
+        path = os.path.join(cwd, ATTACHMENT_DIR, re.sub(r'[^A-Za-z0-9._-]+', '_', session.session))
+        os.makedirs(path, exist_ok=True)
+        return cwd, path
+
+    async def ingest(self, attachments, session):
+        # 保存したファイルの @ 参照と、スキップしたファイル名（理由付き）を返す
+        cwd, path = await self.workdir(session)
+        remaining = [self.budget]
+        skipped = []
+
+        async def fetch(att):
+            if att.size > self.max_bytes:
+                skipped.append(f"{att.filename} (1 ファイル {self.max_bytes // (1024 * 1024)}MB まで)")
+                return None
+            async with self._sem:
+                # ダウンロードの直前に予約する（並行ダウンロードでも合計を超えず、失敗して戻った分は後のファイルが使える）
+                if att.size > remaining[0]:
+                    skipped.append(f"{att.filename} (合計 {self.budget // (1024 * 1024)}MB まで)")
+                    return None
+                remaining[0] -= att.size
+                try:
+                    with metrics.timer("attachment_download_seconds"):
+                        saved = await self._download(att, path)
+                except Exception as e:
+                    # 予約した分を戻して、同じメッセージの他のファイルが合計の上限で断られないようにする
+                    remaining[0] += att.size
+                    print(f"DEBUG: Failed to download attachment {att.filename}: {e}")
+                    skipped.append(f"{att.filename} (ダウンロード失敗)")
+                    return None
+            metrics.inc("attachments_total")
+            return saved
+
+        saved = await asyncio.gather(*(fetch(a) for a in attachments))
+        refs = []
+        for p in saved:
+            if p is None:
+                continue
+            rel = os.path.relpath(p, cwd)
+            ref = "@" + (rel if not rel.startswith("..") else p)
+            if ref not in refs:  # 同じ内容のファイルは 1 回だけ渡す
+                refs.append(ref)
+        return refs, skipped
+
+    async def _download(self, att, path):
+        http = await self._session()
+        digest = hashlib.sha256()
+        size = 0
+        tmp = os.path.join(path, f".{att.id}.part")
+        try:
+            async with http.get(att.url) as resp:
+                resp.raise_for_status()
+                with open(tmp, "wb") as f:
+                    async for chunk in resp.content.iter_chunked(self.CHUNK):
+                        size += len(chunk)
+                        # 予約したのは申告されたサイズの分だけなので、それを超えたら断る
+                        if size > min(self.max_bytes, att.size):
+                            raise ValueError(f"larger than the declared {att.size} bytes")
+                        digest.update(chunk)
+                        f.write(chunk)
+            h = digest.hexdigest()[:16]
+            # 同じ内容のファイルが既にあれば、それを使う
+            for existing in os.listdir(path):
+                if existing.startswith(h + "-"):
+                    metrics.inc("attachments_deduplicated_total")
+                    return os.path.join(path, existing)
+            final = os.path.join(path, f"{h}-{self._safe_name(att.filename)}")
+            os.replace(tmp, final)
+            return final
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    async def close(self):
+        if self._http and not self._http.closed:
+            await self._http.close()
+
+
+class TranscriptStore:
+    # プロンプトと応答のチャンクを SQLite (WAL + FTS5) に追記していく
+    # 書き込みは専用スレッドがまとめて行うので、イベントループは待たされない
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS prompts (
+        id TEXT PRIMARY KEY, session TEXT, backend TEXT, channel_id INTEGER, prompt TEXT,
+        status TEXT, created REAL, started REAL, first_chunk REAL, finished REAL);
+    CREATE INDEX IF NOT EXISTS prompts_status ON prompts(status);
+    CREATE TABLE IF NOT EXISTS chunks (
+        prompt_id TEXT, idx INTEGER, content TEXT, message_id INTEGER, updated REAL,
+        PRIMARY KEY (prompt_id, idx));
+    CREATE VIRTUAL TABLE IF NOT EXISTS transcript_fts USING fts5(prompt, response);
+    """
+
+    def __init__(self, path=TRANSCRIPT_DB, flush=TRANSCRIPT_FLUSH):
+        self.path = path
+        self.flush = flush
+        self.queue = SimpleQueue()
+        self.thread = None
+        self.closed = False
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def start(self):
+        if not self.enabled or self.thread:
+            return
+        conn = self._connect()
+        conn.executescript(self.SCHEMA)
+        conn.close()
+        self.thread = threading.Thread(target=self._run, name="transcripts", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            batch = [self.queue.get()]
+            # flush 秒の間に来た書き込みを 1 トランザクションにまとめる
+            deadline = time.monotonic() + self.flush
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except Empty:
+                    break
+            started = time.perf_counter()
+            try:
+                with conn:
+                    for item in batch:
+                        if item is not None:
+                            conn.execute(*item)
+            except sqlite3.Error as e:
+                print(f"DEBUG: Transcript write failed: {e}")
+            metrics.observe("transcript_flush_seconds", time.perf_counter() - started)
+            if batch[-1] is None:
+                conn.close()
+                return
+
+    def _put(self, sql, params):
+        if self.thread and not self.closed:
+            self.queue.put((sql, params))
+
+    def begin(self, session, channel, prompt, created=None):
+        pid = uuid.uuid4().hex
+        now = time.time()
+        self._put("INSERT INTO prompts (id, session, backend, channel_id, prompt, status, created, started) VALUES (?, ?, ?, ?, ?, 'running', ?, ?)",
+                  (pid, session.target, session.backend.name, getattr(channel, "id", None), prompt, created or now, now))
+        return pid
+
+    def chunk(self, pid, idx, content, message):
+        now = time.time()
+        self._put("INSERT INTO chunks (prompt_id, idx, content, message_id, updated) VALUES (?, ?, ?, ?, ?) "
+                  "ON CONFLICT (prompt_id, idx) DO UPDATE SET content = excluded.content, "
+                  "message_id = COALESCE(excluded.message_id, message_id), updated = excluded.updated",
+                  (pid, idx, content, getattr(message, "id", None), now))
+        if idx == 0:
+            self._put("UPDATE prompts SET first_chunk = COALESCE(first_chunk, ?) WHERE id = ?", (now, pid))
+
+    def finish(self, pid, status):
+        self._put("UPDATE prompts SET status = ?, finished = ? WHERE id = ?", (status, time.time(), pid))
+        # 全文検索の索引は完了時に 1 回だけ作る
+        self._put("INSERT INTO transcript_fts (rowid, prompt, response) SELECT rowid, prompt, "
+                  "(SELECT group_concat(content, char(10)) FROM (SELECT content FROM chunks WHERE prompt_id = ? ORDER BY idx)) "
+                  "FROM prompts WHERE id = ?", (pid, pid))
+
+    def _read(self, sql, params):
+        conn = self._connect()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    async def search(self, query, limit=5):
+        # 入力はそのまま FTS5 の構文にせず、語ごとにフレーズとして扱う
+        terms = " ".join('"' + t.replace('"', '""') + '"' for t in query.split())
+        if not self.thread or not terms:
+            return []
+        return await asyncio.to_thread(self._read, """
+            SELECT p.id, p.session, p.channel_id, p.created, p.prompt,
+                   snippet(transcript_fts, 1, '**', '**', '…', 16),
+                   (SELECT message_id FROM chunks WHERE prompt_id = p.id AND message_id IS NOT NULL ORDER BY idx LIMIT 1)
+            FROM transcript_fts JOIN prompts p ON p.rowid = transcript_fts.rowid
+            WHERE transcript_fts MATCH ? ORDER BY rank LIMIT ?""", (terms, limit))
+
+    async def interrupted(self):
+        # 前回の実行で完了しなかったプロンプトと、送信済みのチャンク
+        if not self.thread:
+            return []
+        rows = await asyncio.to_thread(self._read, "SELECT id, session, backend, channel_id, prompt FROM prompts WHERE status = 'running' ORDER BY created", ())
+        result = []
+        for pid, target, backend, channel_id, prompt in rows:
+            chunks = await asyncio.to_thread(self._read, "SELECT idx, content, message_id FROM chunks WHERE prompt_id = ? ORDER BY idx", (pid,))
+            result.append((pid, target, backend, channel_id, prompt, chunks))
+        return result
+
+    def close(self):
+        # 以降の書き込み（終了時のキャンセルによる finish など）は捨て、残りを書き切る
+        if self.thread and not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+
+
+class CompletionDetector:
+    # 応答が終わったかを画面の状態から判断する。セッションごとに出力の間隔を学習しておく
+    SPINNER = set("⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏")
+    BUSY_MARKERS = ("esc to cancel", "Press Ctrl+C")
+    SAMPLES = 500
+
+    def __init__(self):
+        self.gaps = collections.deque(maxlen=self.SAMPLES)  # 応答中の画面更新の間隔（秒）
+
+    def observe_gap(self, gap):
+        self.gaps.append(gap)
+
+    def quiet_threshold(self):
+        # 手がかりがないときに「終わった」とみなす無音の長さ。十分に学習するまでは上限を使う
+        if len(self.gaps) < 20:
+            return QUIET_MAX
+        gaps = sorted(self.gaps)
+        p99 = gaps[min(len(gaps) - 1, int(0.99 * len(gaps)))]
+        return max(QUIET_MIN, min(QUIET_MAX, p99 * 3))
+
+    @staticmethod
+    def _status_lines(lines):
+        # スピナーが出る場所: 一番下の行と、画面下部の入力欄のすぐ上の行
+        # 回答の本文に "esc to cancel" などが書かれていても busy と取り違えないよう、それ以外は見ない
+        status = [lines[-1]]
+        for i in range(len(lines) - 1, max(-1, len(lines) - 5), -1):
+            if "Type your message" in lines[i] or lines[i][:1] == "*":
+                for l in reversed(lines[:i]):
+                    if l.strip("".join(BOX_CHARS) + " "):
+                        status.append(l)
+                        break
+                break
+        return status
+
+    def state(self, pane_text):
+        # 画面下部から "busy"（スピナーや中断の案内）/ "ready"（入力欄）/ "unknown" を返す
+        lines = [l.strip() for l in pane_text.splitlines() if l.strip()][-12:]
+        if not lines:
+            return "unknown"
+        for l in self._status_lines(lines):
+            body = l.strip("".join(BOX_CHARS) + " ")
+            if body[:1] in self.SPINNER or any(m in l for m in self.BUSY_MARKERS):
+                return "busy"
+        if GeminiSession._has_prompt("\n".join(lines)):
+            return "ready"
+        return "unknown"
+
+
+class GeminiUnavailableError(Exception):
+    # ウォッチドッグが Gemini を再起動したため、処理中・順番待ちのプロンプトを取り消した
+    pass
+
+
+class QuotaExceededError(Exception):
+    # ユーザーごとの上限を超えたプロンプト。メッセージはそのまま利用者に返す
+    pass
+
+
+class AccessControl:
+    # 誰が使えるか（ID・ロールの許可リスト）と、ユーザーごとの上限・利用状況
+    def __init__(self):
+        self.inflight = collections.Counter()  # user_id -> 受け付けて終わっていないプロンプト数
+        self.recent = collections.defaultdict(collections.deque)  # user_id -> 直近 60 秒の受付時刻
+        self.usage = collections.defaultdict(collections.Counter)  # user_id -> 利用状況
+        self.names = {}  # user_id -> 表示名
+
+    @staticmethod
+    def is_owner(user):
+        return bool(MY_DISCORD_ID) and str(user.id) == str(MY_DISCORD_ID)
+
+    def is_allowed(self, user):
+        if self.is_owner(user) or str(user.id) in ALLOWED_USER_IDS:
+            return True
+        # DM では User なのでロールはない
+        return any(str(r.id) in ALLOWED_ROLE_IDS for r in getattr(user, "roles", []))
+
+    @staticmethod
+    def weight(user_id):
+        return max(0.01, USER_WEIGHTS.get(str(user_id), 1.0))
+
+    def check(self, user, prompt=""):
+        # 上限を超えていれば QuotaExceededError。何も数えないので、添付のダウンロード前にも使える
+        if user is None or self.is_owner(user):
+            return
+        uid = str(user.id)
+        recent = self.recent[uid]
+        now = time.monotonic()
+        while recent and now - recent[0] > 60:
+            recent.popleft()
+        size = len(prompt.encode())
+        reason = None
+        if size > USER_MAX_PROMPT_BYTES:
+            reason = ("bytes", f"プロンプトが長すぎるよ（{size} / {USER_MAX_PROMPT_BYTES} バイト）。")
+        elif self.inflight[uid] >= USER_MAX_INFLIGHT:
+            reason = ("inflight", f"同時に送れるのは {USER_MAX_INFLIGHT} 件までだよ。前の応答が終わるまで待ってね。")
+        elif len(recent) >= USER_PROMPTS_PER_MINUTE:
+            reason = ("rate", f"1 分に送れるのは {USER_PROMPTS_PER_MINUTE} 件までだよ。少し待ってね。")
+        if reason:
+            self.usage[uid][f"rejected_{reason[0]}"] += 1
+            raise QuotaExceededError(reason[1])
+
+    def admit(self, user, prompt):
+        # 上限内なら処理中に数える。超えていれば QuotaExceededError
+        if user is None:
+            return None
+        self.check(user, prompt)
+        uid = str(user.id)
+        self.names[uid] = str(user)
+        self.inflight[uid] += 1
+        return uid
+
+    def accept(self, uid, prompt):
+        # 順番待ちに入ったプロンプトだけを 1 分あたりの件数と利用状況に数える
+        if uid is None:
+            return
+        if str(uid) != str(MY_DISCORD_ID):
+            self.recent[uid].append(time.monotonic())
+        self.usage[uid]["prompts"] += 1
+        self.usage[uid]["bytes"] += len(prompt.encode())
+
+    def release(self, uid):
+        if uid is not None:
+            self.inflight[uid] -= 1
+
+    def record(self, uid, wait, seconds):
+        if uid is not None:
+            self.usage[uid]["queue_seconds"] += wait
+            self.usage[uid]["busy_seconds"] += seconds
+
+    def collect(self):
+        # /metrics 用: ユーザーごとのカウンタ
+        out = []
+        for uid, usage in self.usage.items():
+            for key, value in usage.items():
+                name = f"gemini_user_{key}_total"
+                out.append((name, f'user="{uid}"', round(value, 3) if isinstance(value, float) else value))
+        return out
+
+
+class FairScheduler:
+    # 重み付きの公平な順番（start-time fair queuing）。ユーザーごとの仮想時刻が小さいプロンプトから処理する
+    # 見積もった処理時間で順番を決め、終わったら実際にかかった時間で差を精算する
+    DEFAULT_COST = 10.0  # まだ実績のないユーザーの 1 件あたりの見積もり（秒）
+
+    def __init__(self, access):
+        self.access = access
+        self.virtual = 0.0
+        self.finish = {}  # user_id -> 最後に割り当てた仮想終了時刻
+        self.cost = {}  # user_id -> 1 件あたりの処理時間の見積もり（秒、指数移動平均）
+
+    def enqueue(self, job):
+        uid = job.user_id
+        start = max(self.virtual, self.finish.get(uid, 0.0))
+        job.tag = start
+        job.estimate = self.cost.get(uid, self.DEFAULT_COST)
+        self.finish[uid] = start + job.estimate / self.access.weight(uid)
+
+    @staticmethod
+    def key(job):
+        return (job.tag, job.created)
+
+    def order(self, jobs):
+        return sorted(jobs, key=self.key)
+
+    def start(self, job):
+        self.virtual = max(self.virtual, job.tag)
+
+    def refund(self, job):
+        # 処理されずに消えたプロンプトの見積もり分を戻す
+        uid = job.user_id
+        self.finish[uid] = max(self.virtual, self.finish.get(uid, 0.0) - job.estimate / self.access.weight(uid))
+
+    def charge(self, job, seconds):
+        uid = job.user_id
+        self.finish[uid] = self.finish.get(uid, 0.0) + (seconds - job.estimate) / self.access.weight(uid)
+        self.cost[uid] = 0.7 * self.cost.get(uid, self.DEFAULT_COST) + 0.3 * seconds
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class PromptJob:
+    # 順番待ち中のプロンプト 1 件
+    def __init__(self, prompt, channel, user_id=None):
+        self.prompt = prompt
+        self.channel = channel
+        self.user_id = user_id  # None はボット自身（ベンチマークなど）
+        self.tag = 0.0  # FairScheduler の仮想開始時刻
+        self.estimate = 0.0
+        self.future = asyncio.get_running_loop().create_future()
+        self.created = self.updated = asyncio.get_running_loop().time()
+        self.notice = None  # 「順番待ち」表示のメッセージ
+        self.shown_ahead = None
+
+    def merge(self, prompt):
+        self.prompt += "\n" + prompt
+        self.updated = asyncio.get_running_loop().time()
+
+    @property
+    def preview(self):
+        text = self.prompt.replace("\n", " ")
+        return text[:50] + ("…" if len(text) > 50 else "")
+
+
+class TmuxBackend:
+    # tmux のペインで対話モードの Gemini を動かし、画面を読み取って応答を取り出す
+    name = "tmux"
+
+    def __init__(self, session):
+        self.session = session
+
+    async def ensure_active(self):
+        await self.session.ensure_active()
+
+    async def ask(self, prompt, channel):
+        await self.session._ask_pane(prompt, channel)
+
+    async def interrupt(self):
+        # Gemini 側の生成も止める
+        await self.session.tmux.send_keys(self.session.target, "Escape")
+
+    async def cwd(self):
+        # 取れなければボットのディレクトリ
+        res = await self.session.tmux.run("display-message", "-p", "-t", self.session.target, "#{pane_current_path}")
+        return res.stdout.strip() if res.ok and res.stdout.strip() else os.path.dirname(os.path.abspath(__file__))
+
+
+class HeadlessBackend:
+    # プロンプトごとに gemini -p を stream-json で起動し、イベントをそのままチャンクにする
+    # 画面の capture も正規表現での解析もいらない
+    name = "headless"
+
+    def __init__(self, session):
+        self.session = session
+        self.session_id = None  # 次の --resume に使う Gemini 側のセッション ID
+
+    async def ensure_active(self):
+        # 常駐プロセスはないので、コマンドが見つかるかだけ確認する
+        if not shutil.which(shlex.split(GEMINI_HEADLESS_CMD)[0]):
+            print(f"DEBUG: Headless Gemini command not found: {GEMINI_HEADLESS_CMD}")
+
+    async def interrupt(self):
+        # 処理中のタスクをキャンセルすればプロセスも止まる
+        pass
+
+    async def cwd(self):
+        return GEMINI_HEADLESS_CWD
+
+    def _command(self, prompt):
+        cmd = shlex.split(GEMINI_HEADLESS_CMD) + ["--prompt", prompt]
+        if HEADLESS_RESUME and self.session_id:
+            cmd += ["--resume", self.session_id]
+        return cmd
+
+    def _tool_block(self, tool, result):
+        params = " ".join(f"{k}={v}" for k, v in (tool.get("parameters") or {}).items())
+        mark = {"success": "✓", "error": "✗"}.get(result.get("status") if result else None, "…")
+        lines = [f"{mark} {tool.get('tool_name', '?')} {params}"[:300]]
+        output = (result or {}).get("output") or (result or {}).get("error", {}).get("message", "")
+        lines += str(output).splitlines()
+        return "```\n" + "\n".join(lines) + "\n```"
+
+    async def _read_events(self, proc, outbox, started):
+        # stream-json のイベントを読んでチャンクにする。失敗した場合は理由を返す
+        loop = asyncio.get_running_loop()
+        chunks = []  # 表示するチャンク（✦ の本文 or ツールのコードブロック）
+        tools = {}  # tool_id -> (chunk index, tool_use イベント)
+        logs = set()  # ツールのチャンク番号（大きければ outbox が添付にまとめる）
+        text_idx = None
+        error = None
+        first_chunk = False
+        while True:
+            remaining = RESPONSE_TIMEOUT - (loop.time() - started)
+            try:
+                line = await asyncio.wait_for(proc.stdout.readline(), max(0, remaining))
+            except asyncio.TimeoutError:
+                print(f"DEBUG: Headless Gemini timed out for {self.session.target}")
+                return f"{RESPONSE_TIMEOUT} 秒以内に応答が終わらなかったよ"
+            if not line:
+                return error
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue  # JSON 以外の行（警告など）は無視
+            kind = event.get("type")
+            changed = None
+            if kind == "init":
+                self.session_id = event.get("session_id") or self.session_id
+            elif kind == "message" and event.get("role") == "assistant":
+                if text_idx is None:
+                    chunks.append("✦ ")
+                    text_idx = len(chunks) - 1
+                chunks[text_idx] += event.get("content", "")
+                changed = text_idx
+            elif kind == "tool_use":
+                chunks.append(self._tool_block(event, None))
+                tools[event.get("tool_id")] = (len(chunks) - 1, event)
+                logs.add(len(chunks) - 1)
+                text_idx = None  # ツールの後の本文は新しいチャンクにする
+                changed = len(chunks) - 1
+            elif kind == "tool_result" and event.get("tool_id") in tools:
+                changed, tool = tools[event.get("tool_id")]
+                chunks[changed] = self._tool_block(tool, event)
+            elif kind == "error":
+                print(f"DEBUG: Headless Gemini error: {event.get('message')}")
+            elif kind == "result" and event.get("status") != "success":
+                error = (event.get("error") or {}).get("message") or event.get("status")
+            if changed is not None and chunks[changed].strip() not in ("", "✦"):
+                if not first_chunk:
+                    first_chunk = True
+                    metrics.observe("gemini_first_chunk_seconds", loop.time() - started)
+                outbox.update(changed, self.session.bridge._fix_japanese_line_breaks(chunks[changed]), log=changed in logs)
+
+    async def ask(self, prompt, channel):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        outbox = self.session.open_outbox(channel)
+        print(f"DEBUG: Running headless Gemini for {self.session.target}: {prompt[:100]}")
+        proc = None
+        stderr = ""
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *self._command(prompt), cwd=await self.cwd(),
+                stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                limit=16 * 1024 * 1024)
+            stderr_task = asyncio.create_task(proc.stderr.read())
+            try:
+                error = await self._read_events(proc, outbox, started)
+            finally:
+                if proc.returncode is None:
+                    try:
+                        proc.kill()
+                    except ProcessLookupError:
+                        pass
+                await proc.wait()
+                stderr = (await stderr_task).decode(errors="ignore").strip()
+        except OSError as e:
+            # コマンドが見つからない・作業ディレクトリがないなど
+            error = f"{GEMINI_HEADLESS_CMD}: {e}"
+        finally:
+            # キャンセルや例外の場合も、届いている分は送り切る
+            metrics.observe("gemini_response_seconds", loop.time() - started)
+            await outbox.close()
+
+        if not error and proc and proc.returncode and not outbox.handles:
+            error = stderr.splitlines()[-1] if stderr else f"exit status {proc.returncode}"
+        if error:
+            metrics.inc("gemini_backend_errors_total", 'backend="headless"')
+            await channel.send(f"⚠️ Gemini がエラーを返したよ: `{error}`"[:2000])
+        elif not outbox.handles:
+            metrics.inc("gemini_empty_responses_total")
+            await channel.send("（応答を抽出できませんでした）")
+        else:
+            print(f"DEBUG: Interaction complete. Sent {len(outbox.handles)} chunks.")
+
+
+BACKENDS = {b.name: b for b in (TmuxBackend, HeadlessBackend)}
+SHELLS = {"sh", "bash", "zsh", "fish", "dash", "ksh", "tcsh", "csh"}  # pane_current_command がこれなら Gemini は動いていない
+
+
+class GeminiSession:
+    # 1 つの tmux ターゲット（= 1 つの Gemini インスタンス）を担当するワーカー
+    # ターゲットごとにロックとキューを持つので、別セッション宛てのプロンプトは並行して処理される
+    def __init__(self, bridge, session, window="0"):
+        self.bridge = bridge
+        self.tmux = bridge.tmux
+        self.session = session
+        self.window = window
+        self.lock = asyncio.Lock()
+        self.jobs = collections.deque()  # 順番待ちの PromptJob
+        self.current = None  # 処理中の PromptJob
+        self.current_task = None
+        self.wakeup = asyncio.Event()
+        self.worker = None
+        self.transcript_id = None  # 処理中のプロンプトの記録
+        self.detector = CompletionDetector()
+        self.last_progress = None  # 応答中に最後に画面が動いた時刻（ウォッチドッグ用）
+        self.backend = BACKENDS.get(bridge.backend_choices.get(self.target, GEMINI_BACKEND), TmuxBackend)(self)
+
+    @property
+    def target(self):
+        return f"{self.session}:{self.window}"
+
+    @property
+    def busy(self):
+        return self.lock.locked() or self.current is not None or bool(self.jobs)
+
+    def _merge_target(self, channel, user_id):
+        # 直前に同じチャンネル・同じ人から来て、まだ始まっていないプロンプトがあればそこにまとめる
+        if MERGE_WINDOW <= 0 or not self.jobs:
+            return None
+        job = self.jobs[-1]
+        if job.channel.id == channel.id and job.user_id == user_id and asyncio.get_running_loop().time() - job.updated <= MERGE_WINDOW:
+            return job
+        return None
+
+    async def submit(self, prompt, channel, user_id=None):
+        # ワーカーに依頼して、応答が終わるまで待つ。キャンセルされた場合は None
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._work())
+        job = self._merge_target(channel, user_id)
+        if job:
+            job.merge(prompt)
+            print(f"DEBUG: Merged burst message into queued prompt for {self.target}")
+        else:
+            if len(self.jobs) >= QUEUE_MAX:
+                raise QueueFullError(self.target)
+            job = PromptJob(prompt, channel, user_id)
+            self.bridge.fair.enqueue(job)
+            self.jobs.append(job)
+            self.wakeup.set()
+            await self._refresh_notices()
+        self.bridge.access.accept(user_id, prompt)
+        try:
+            async with channel.typing():
+                return await job.future
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            return None
+
+    def _ahead(self, job):
+        return self.bridge.fair.order(self.jobs).index(job) + (1 if self.current else 0)
+
+    async def _refresh_notices(self):
+        # 順番待ちの表示を投稿・更新する
+        for job in list(self.jobs):
+            ahead = self._ahead(job)
+            if ahead == 0 or ahead == job.shown_ahead:
+                continue
+            job.shown_ahead = ahead
+            text = f"⏳ 順番待ち中だよ（前に {ahead} 件）。`/cancel` で取り消せるよ。"
+            try:
+                if job.notice is None:
+                    job.notice = await job.channel.send(text)
+                else:
+                    await job.notice.edit(content=text)
+            except Exception as e:
+                print(f"DEBUG: Failed to update queue notice: {e}")
+
+    async def _clear_notice(self, job, text=None):
+        if job.notice is None:
+            return
+        try:
+            if text:
+                await job.notice.edit(content=text)
+            else:
+                await job.notice.delete()
+        except Exception:
+            pass
+        job.notice = None
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self.jobs:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            # 到着順ではなく、ユーザーごとの公平な順番で選ぶ
+            job = min(self.jobs, key=self.bridge.fair.key)
+            # 連投をまとめるため、最後のメッセージから MERGE_WINDOW 秒待つ
+            wait = job.updated + MERGE_WINDOW - loop.time()
+            if MERGE_WINDOW > 0 and wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            self.jobs.remove(job)
+            self.bridge.fair.start(job)
+            queued = loop.time() - job.created
+            metrics.observe("gemini_queue_wait_seconds", queued)
+            started = loop.time()
+            self.current = job
+            await self._clear_notice(job)
+            await self._refresh_notices()
+            try:
+                async with self.lock:
+                    created = time.time() - (loop.time() - job.created)
+                    self.current_task = asyncio.create_task(self.ask(job.prompt, job.channel, created))
+                    result = await self.current_task
+                if not job.future.done():
+                    job.future.set_result(result)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                if asyncio.current_task().cancelling():
+                    raise
+            except Exception as e:
+                print(f"DEBUG: Worker for {self.target} failed: {e}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self.current = None
+                self.current_task = None
+                self.bridge.fair.charge(job, loop.time() - started)
+                self.bridge.access.record(job.user_id, queued, loop.time() - started)
+            await self._refresh_notices()
+
+    async def cancel(self, channel=None, user_id=None):
+        # channel 宛て（None なら全部）、user_id が指定されればその人のプロンプトだけを取り消す
+        # (待ち件数, 処理中を止めたか) を返す
+        def match(j):
+            return (channel is None or j.channel.id == channel.id) and (user_id is None or j.user_id == user_id)
+        dropped = [j for j in self.jobs if match(j)]
+        for job in dropped:
+            self.jobs.remove(job)
+            self.bridge.fair.refund(job)
+            job.future.cancel()
+            await self._clear_notice(job, "🚫 キャンセルしたよ。")
+        stopped = False
+        job = self.current
+        if job and self.current_task and match(job):
+            self.current_task.cancel()
+            await self.backend.interrupt()
+            stopped = True
+        await self._refresh_notices()
+        return len(dropped), stopped
+
+    async def stop(self):
+        if self.worker and not self.worker.done():
+            self.worker.cancel()
+        while self.jobs:
+            job = self.jobs.popleft()
+            self.bridge.fair.refund(job)
+            job.future.cancel()
+
+    async def _pane_id(self, stream):
+        if stream:
+            ok, out = await stream.command(["display-message", "-p", "-t", self.target, "#{pane_id}"])
+            if ok and out:
+                return out[0].strip()
+        return (await self.tmux.output("display-message", "-p", "-t", self.target, "#{pane_id}")).strip()
+
+    async def _capture(self, stream):
+        args = ["capture-pane", "-t", self.target, "-p", "-J", "-S", "-500"]
+        if stream and stream.alive:
+            ok, out = await stream.command(args)
+            if ok:
+                return "\n".join(out) + "\n"
+        return await self.tmux.output(*args)
+
+    async def _wait_for_update(self, stream, pane_id):
+        # %output が来るまで待つ。コントロールモードが使えなければ従来通りのポーリング
+        if stream and stream.alive and pane_id:
+            await stream.wait_for_output(pane_id, STREAM_IDLE_TICK)
+            await asyncio.sleep(STREAM_MIN_INTERVAL)  # 連続した出力をまとめる
+        else:
+            await asyncio.sleep(2)
+
+    async def _screen(self, stream):
+        # 表示中の画面だけ（履歴なし）
+        args = ["capture-pane", "-t", self.target, "-p", "-J"]
+        if stream and stream.alive:
+            ok, out = await stream.command(args)
+            if ok:
+                return "\n".join(out) + "\n"
+        return await self.tmux.output(*args)
+
+    async def _wait_until(self, predicate, timeout):
+        # 条件を満たすまで画面を確認する。%output が来れば即座に、来なければ短いバックオフで再確認
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        stream = await self.bridge._get_stream(self.session)
+        pane_id = await self._pane_id(stream)
+        delay = 0.05
+        while True:
+            if predicate(await self._screen(stream)):
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            if stream and stream.alive and pane_id:
+                await stream.wait_for_output(pane_id, min(delay, remaining))
+            else:
+                await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.5)
+
+    @staticmethod
+    def _has_prompt(screen):
+        # Gemini のプロンプト (* Type your message...) が出ているか
+        lines = [l.strip() for l in screen.splitlines() if l.strip()]
+        return any("Type your message" in l or "*" == l[:1] for l in lines[-10:])
+
+    async def wait_for_prompt(self, timeout=READY_TIMEOUT):
+        # Gemini の入力待ち（空の入力欄）になるまで待つ
+        return await self._wait_until(self._has_prompt, timeout)
+
+    async def wait_for_echo(self, text, timeout=INPUT_TIMEOUT):
+        # 送ったテキストが入力欄に表示されるまで待つ（末尾で判定）
+        tail = text.strip().splitlines()[-1].strip()[-15:] if text.strip() else ""
+        return await self._wait_until(lambda screen: tail in screen, timeout)
+
+    async def _paste(self, text):
+        # 大きい・複数行のプロンプトはバッファ経由で一度に貼り付ける
+        buf = f"gemini-bot-{self.session}"
+        if not (await self.tmux.load_buffer(buf, text)).ok or not (await self.tmux.paste_buffer(buf, self.target)).ok:
+            print(f"DEBUG: paste-buffer failed for {self.target}, falling back to send-keys")
+            await self.tmux.send_keys(self.target, text, literal=True)
+        # 末尾まで届いたことを確認してから Enter を押す（大きな貼り付けは [Pasted Text] 表示になることがある）
+        tail = text.strip().splitlines()[-1].strip()[-15:] if text.strip() else ""
+        if not await self._wait_until(lambda screen: tail in screen or "[Pasted" in screen, INPUT_TIMEOUT):
+            print(f"DEBUG: Pasted prompt not confirmed in {self.target}, submitting anyway")
+        await self.wait_for_idle(quiet=0.2)
+
+    async def wait_for_idle(self, quiet=0.3, timeout=INPUT_TIMEOUT):
+        # 出力が quiet 秒途切れるまで待つ
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        stream = await self.bridge._get_stream(self.session)
+        pane_id = await self._pane_id(stream)
+        if not (stream and stream.alive and pane_id):
+            last = None
+            while loop.time() < deadline:
+                screen = await self._screen(stream)
+                if screen == last:
+                    return True
+                last = screen
+                await asyncio.sleep(quiet)
+            return False
+        while loop.time() < deadline:
+            if not await stream.wait_for_output(pane_id, min(quiet, deadline - loop.time())):
+                return True
+        return False
+
+    async def ensure_active(self, use_pool=True):
+        if not await self.tmux.has_session(self.target):
+            # プールに起動済みのペインがあれば、それを引き継ぐ（引き継いだ後も下の確認は通す）
+            if not (use_pool and self.window == "0" and await self.bridge.pool.claim(self.session)):
+                # Create session if it doesn't exist, or a new window
+                await self.tmux.new_session(self.session)
+                # シェルの起動（プロンプト表示）が落ち着くまで
+                await self.wait_for_idle()
+        
+        # Ensure proper size for Gemini CLI output
+        await self.tmux.run("resize-pane", "-t", self.target, "-x", "500", "-y", "100")
+        
+        # 画面をチェックして、Gemini のプロンプトがあるか確認（落ちた後の画面が残っているだけなら起動し直す）
+        if await self.wait_for_prompt(timeout=0) and await self._pane_state() == "running":
+            return
+        
+        # Gemini のプロンプトが見つからない場合は起動を試みる
+        print(f"DEBUG: Gemini prompt not found in {self.target}. Starting Gemini...")
+        # Bashの入力をクリアしてから起動
+        await self.tmux.send_keys(self.target, "C-c", "C-u")
+        await self.wait_for_idle(quiet=0.2)
+        await self.tmux.send_keys(self.target, GEMINI_CMD, "Enter")
+        # 起動を待つ
+        if not await self.wait_for_prompt():
+            print(f"DEBUG: Gemini did not show its prompt in {self.target} within {READY_TIMEOUT}s")
+
+    async def ask(self, prompt, channel, created=None):
+        metrics.inc("gemini_prompts_total", f'backend="{self.backend.name}"')
+        self.last_progress = asyncio.get_running_loop().time()
+        transcripts = self.bridge.transcripts
+        self.transcript_id = transcripts.begin(self, channel, prompt, created)
+        status = "error"
+        try:
+            await self.backend.ask(prompt, channel)
+            status = "done"
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            transcripts.finish(self.transcript_id, status)
+            self.transcript_id = None
+
+    def open_outbox(self, channel, pid=None):
+        # 送信・編集したチャンクを記録する outbox
+        outbox = self.bridge.edits.open(channel)
+        pid = pid or self.transcript_id
+        if pid:
+            outbox.on_sent = lambda idx, content, message: self.bridge.transcripts.chunk(pid, idx, content, message)
+        return outbox
+
+    async def reattach(self, pid, prompt, channel, chunks):
+        # 再起動前に送っていたメッセージを引き継いで、ペインの応答を最後まで流す
+        # 呼び出し側で self.lock を取得済みであること
+        try:
+            outbox = self.open_outbox(channel, pid)
+            for idx, content, message_id in chunks:
+                if idx != len(outbox.handles):
+                    break
+                outbox.handles.append(channel.get_partial_message(message_id) if message_id else None)
+                outbox.sent.append(content)
+            print(f"DEBUG: Reattaching to interrupted response in {self.target} ({len(outbox.handles)} chunks sent)")
+            self.current_task = asyncio.current_task()
+            self.last_progress = asyncio.get_running_loop().time()
+            status = "error"
+            try:
+                await self._stream_pane(prompt, channel, outbox)
+                status = "done"
+            finally:
+                self.bridge.transcripts.finish(pid, status)
+        finally:
+            self.current_task = None
+            self.lock.release()
+
+    async def _cursor_at_prompt(self, stream):
+        # カーソルが入力欄の行にあるか。回答中の "* 箇条書き" を入力欄と取り違えないための確認
+        args = ["display-message", "-p", "-t", self.target, "#{cursor_y}"]
+        out = None
+        if stream and stream.alive:
+            ok, lines = await stream.command(args)
+            out = lines[0] if ok and lines else None
+        if out is None:
+            res = await self.tmux.run(*args)
+            out = res.stdout if res.ok else ""
+        if not out.strip().isdigit():
+            return True  # 取れなければ画面だけで判断する
+        y = int(out.strip())
+        # 折り返しを繋げない（-J なし）キャプチャなら、行番号がそのまま画面の行になる
+        args = ["capture-pane", "-t", self.target, "-p"]
+        if stream and stream.alive:
+            ok, screen = await stream.command(args)
+        else:
+            ok, screen = False, None
+        if not ok:
+            screen = (await self.tmux.output(*args)).split("\n")
+        return self._has_prompt("\n".join(screen[max(0, y - 1):y + 2]))
+
+    async def _pane_state(self):
+        return await self.pane_state(self.tmux, self.target)
+
+    @staticmethod
+    async def pane_state(tmux, target):
+        # "running"（シェル以外が前面にいる）/ "exited"（シェルに戻っている・ペインが死んでいる）/ None（ペインがない）
+        res = await tmux.run("display-message", "-p", "-t", target, "#{pane_dead} #{pane_current_command}")
+        if not res.ok:
+            return None
+        dead, _, command = res.stdout.strip().partition(" ")
+        return "exited" if dead == "1" or command in SHELLS else "running"
+
+    async def health(self):
+        # 応答中に Gemini が落ちた・固まったら理由を返す。待機中は落ちているかだけ見る
+        state = await self._pane_state()
+        if state is None:
+            return None  # セッションがない（次のプロンプトで作られる）
+        if state == "exited":
+            return "crashed"
+        busy = self.current_task is not None and not self.current_task.done()
+        if busy and self.last_progress is not None and asyncio.get_running_loop().time() - self.last_progress > HUNG_TIMEOUT:
+            return "hung"
+        return None
+
+    async def recover(self, reason):
+        # 処理中・順番待ちのプロンプトをすぐに失敗させ、Gemini を起動し直す
+        print(f"DEBUG: Watchdog: Gemini in {self.target} {reason}, restarting")
+        metrics.inc("gemini_watchdog_restarts_total", f'reason="{reason}"')
+        error = GeminiUnavailableError(f"{self.target} {reason}")
+        failed = 0
+        if self.current and not self.current.future.done():
+            self.current.future.set_exception(error)
+            failed += 1
+        while self.jobs:
+            job = self.jobs.popleft()
+            self.bridge.fair.refund(job)
+            if not job.future.done():
+                job.future.set_exception(error)
+                failed += 1
+            await self._clear_notice(job, "⚠️ Gemini を再起動したので取り消したよ。もう一度送ってね。")
+        task = self.current_task
+        if task and not task.done():
+            task.cancel()
+            await asyncio.wait([task], timeout=5)
+        if reason == "crashed" and not failed:
+            # 待機中に落ちていただけなら、起動し直すだけ
+            async with self.lock:
+                await self.ensure_active(use_pool=False)
+            return
+        async with self.lock:
+            # プロセスごと作り直してから Gemini を起動する
+            await self.tmux.run("respawn-pane", "-k", "-t", self.target)
+            await self.wait_for_idle()
+            await self.ensure_active(use_pool=False)
+
+    async def _ask_pane(self, prompt, channel):
+        with metrics.timer("gemini_ensure_active_seconds"):
+            await self.ensure_active()
+        
+        loop = asyncio.get_running_loop()
+        submit_started = loop.time()
+        # 入力行をクリア
+        print(f"DEBUG: Clearing line in {self.target}")
+        await self.tmux.send_keys(self.target, "C-c", "C-u")
+        await self.wait_for_prompt(timeout=INPUT_TIMEOUT)
+        
+        # 文字を送信
+        if "\n" in prompt or len(prompt) > PASTE_THRESHOLD:
+            print(f"DEBUG: Pasting to tmux ({len(prompt)} chars): {prompt[:100]}")
+            with metrics.timer("gemini_paste_seconds"):
+                await self._paste(prompt)
+        else:
+            print(f"DEBUG: Sending to tmux: {prompt}")
+            # 特殊文字による誤動作を防ぐため、文字列をそのまま送る
+            await self.tmux.send_keys(self.target, prompt, literal=True)
+            if not await self.wait_for_echo(prompt):
+                print(f"DEBUG: Prompt echo not seen in {self.target}, submitting anyway")
+        
+        # 実行（Enter を確実に叩く）
+        await self.tmux.send_keys(self.target, "C-m")
+        metrics.observe("gemini_prompt_submit_seconds", loop.time() - submit_started)
+        
+        # 送信直後の状態を保存
+        stream = await self.bridge._get_stream(self.session)
+        initial_pane = await self._capture(stream)
+        await self._stream_pane(prompt, channel, self.open_outbox(channel), initial_pane)
+
+    async def _stream_pane(self, prompt, channel, outbox, initial_pane=None):
+        # ペインを読み続けて、応答が終わるまでチャンクを outbox に流す
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            await self._follow_pane(prompt, outbox, initial_pane)
+        finally:
+            # キャンセルされた場合も、届いている分は送り切る
+            metrics.observe("gemini_response_seconds", loop.time() - started)
+            await outbox.close()
+        if not outbox.handles:
+            metrics.inc("gemini_empty_responses_total")
+            await channel.send("（応答を抽出できませんでした）")
+        else:
+            print(f"DEBUG: Interaction complete. Sent {len(outbox.handles)} chunks.")
+
+    async def _follow_pane(self, prompt, outbox, initial_pane):
+        loop = asyncio.get_running_loop()
+        last_pane = ""
+        stream = await self.bridge._get_stream(self.session)
+        pane_id = await self._pane_id(stream)
+        
+        parser = ResponseParser(prompt)
+        detector = self.detector
+        started = last_change = loop.time()
+        first_chunk = False
+        # 送信直後の画面から変わるまでは、見えているプロンプトは前の応答のもの
+        responded = initial_pane is None
+
+        while loop.time() - started < RESPONSE_TIMEOUT:  # 最大400秒待機
+            await self._wait_for_update(stream, pane_id)
+            with metrics.timer("tmux_capture_seconds"):
+                pane_out = await self._capture(stream)
+            if not pane_out.strip(): continue
+            
+            now = loop.time()
+            if pane_out != last_pane:
+                if last_pane and responded:
+                    detector.observe_gap(now - last_change)
+                last_change = now
+                last_pane = pane_out
+                self.last_progress = now
+                if initial_pane is not None and pane_out != initial_pane:
+                    responded = True
+            idle = now - last_change
+            
+            # 変化がない場合は、初期状態（送信直後）からも変化がないかチェック
+            # これにより、コマンドが全く受け付けられなかった場合を検知できる
+            if idle > 12 and initial_pane is not None and pane_out == initial_pane:
+                print(f"DEBUG: No change detected from initial state for {prompt}. Retrying Enter...")
+                await self.tmux.send_keys(self.target, "C-m")
+                last_change = now
+                responded = True
+                continue
+            
+            # 抽出（前回から変わったチャンクだけが返ってくる）
+            with metrics.timer("gemini_parse_seconds"):
+                changes = parser.feed(pane_out)
+            outbox.truncate(len(parser.responses))
+            if changes and not first_chunk:
+                first_chunk = True
+                responded = True  # 送信直後の画面に既に応答が出ていた場合も
+                metrics.observe("gemini_first_chunk_seconds", loop.time() - started)
+            
+            # リアルタイム送信/編集（実際の API 呼び出しはレート制限を見ながら outbox が行う）
+            for idx, content, is_log in changes:
+                fixed_content = self.bridge._fix_japanese_line_breaks(content) if "✦" in content else content
+                outbox.update(idx, fixed_content, log=is_log)
+            
+            # 完了判定
+            if not responded:
+                continue
+            state = detector.state(pane_out)
+            # カーソルが入力欄に戻っていれば終わり。本物のスピナーは画面を動かし続けるので idle にならず、
+            # 止まった画面に案内の文字が残っているだけなら busy より優先する
+            if idle >= STREAM_MIN_INTERVAL and self._has_prompt(pane_out) and await self._cursor_at_prompt(stream):
+                print(f"DEBUG: Finished because prompt detected ({state}).")
+                return
+            if state == "busy":
+                # スピナーが回っている間は、長いツールの実行でも待つ（固まったらウォッチドッグが拾う）
+                continue
+            quiet = detector.quiet_threshold()
+            if idle >= quiet:
+                print(f"DEBUG: Finished because quiet for {quiet:.1f}s.")
+                return
+        print(f"DEBUG: Finished because response took over {RESPONSE_TIMEOUT}s.")
+
+
+class WarmPool:
+    # 起動済み・入力待ちの Gemini ペインを裏で用意しておくプール
+    # /session_new などで新しいセッションが必要になったら、rename-session するだけで即座に使える
+    def __init__(self, bridge, size=WARM_POOL_SIZE, prefix=WARM_POOL_PREFIX):
+        self.bridge = bridge
+        self.size = size
+        self.prefix = prefix
+        self.ready = collections.deque()  # 入力待ちを確認済みのセッション名
+        self.starting = set()
+        self.spawns = set()  # 起動中の _spawn タスク（参照を持っておかないと GC で消えることがある）
+        self.refill = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        if self.size > 0 and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        await self._adopt()
+        while True:
+            await self._retire_dead()
+            while len(self.ready) + len(self.starting) < self.size:
+                name = f"{self.prefix}{uuid.uuid4().hex[:6]}"
+                self.starting.add(name)
+                task = asyncio.create_task(self._spawn(name))
+                self.spawns.add(task)
+                task.add_done_callback(self.spawns.discard)
+            self.refill.clear()
+            try:
+                await asyncio.wait_for(self.refill.wait(), WARM_POOL_CHECK)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _is_ready(self, name):
+        # Gemini が前面で動いていて、入力欄が出ているか（落ちた後の画面が残っているだけのペインは渡さない）
+        if await GeminiSession.pane_state(self.bridge.tmux, f"{name}:0") != "running":
+            return False
+        screen = await self.bridge.tmux.output("capture-pane", "-t", f"{name}:0", "-p", "-J")
+        return GeminiSession._has_prompt(screen)
+
+    async def _adopt(self):
+        # 前回の起動で残ったペインを引き継ぐ
+        res = await self.bridge.tmux.run("ls", "-F", "#{session_name}")
+        for name in res.stdout.split() if res.ok else []:
+            if not name.startswith(self.prefix):
+                continue
+            if len(self.ready) < self.size and await self._is_ready(name):
+                self.ready.append(name)
+            else:
+                await self.bridge.tmux.kill_session(name)
+        if self.ready:
+            print(f"INFO: Adopted {len(self.ready)} warm Gemini pane(s).")
+
+    async def _spawn(self, name):
+        sess = GeminiSession(self.bridge, name)
+        try:
+            with metrics.timer("gemini_warm_spawn_seconds"):
+                await sess.ensure_active(use_pool=False)
+            if await self._is_ready(name):
+                self.ready.append(name)
+                print(f"DEBUG: Warm pane {name} is ready ({len(self.ready)}/{self.size}).")
+            else:
+                print(f"DEBUG: Warm pane {name} failed to start. Retiring.")
+                await self.bridge.tmux.kill_session(name)
+        except Exception as e:
+            print(f"DEBUG: Warm pane {name} failed: {e}")
+            await self.bridge.tmux.kill_session(name)
+        finally:
+            self.starting.discard(name)
+            await self._drop_stream(name)
+
+    async def _retire_dead(self):
+        for name in list(self.ready):
+            if not await self._is_ready(name):
+                print(f"DEBUG: Warm pane {name} crashed or lost its prompt. Retiring.")
+                self.ready.remove(name)
+                await self.bridge.tmux.kill_session(name)
+
+    async def _drop_stream(self, name):
+        stream = self.bridge.streams.pop(name, None)
+        if stream:
+            await stream.close()
+
+    async def claim(self, new_name):
+        # 確認済みのペインを new_name にリネームして渡す。空なら False
+        try:
+            while self.ready:
+                name = self.ready.popleft()
+                if not await self._is_ready(name):
+                    await self.bridge.tmux.kill_session(name)
+                    continue
+                if (await self.bridge.tmux.run("rename-session", "-t", name, new_name)).ok:
+                    print(f"DEBUG: Claimed warm pane {name} as {new_name}.")
+                    return True
+            return False
+        finally:
+            self.refill.set()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        for task in list(self.spawns):
+            task.cancel()
+
+
+class TmuxGemini:
+    def __init__(self):
         self.current_session = self._load_last_session()
         self.current_window = "0"
+        self.streams = {}  # session -> TmuxControlStream
+        self.sessions = {}  # target -> GeminiSession
+        self.routes = self._load_routes()  # channel_id -> target
+        self.backend_choices = self._load_backends()  # target -> backend 名（既定と違うものだけ）
+        self.tmux = TmuxClient()
+        self.edits = EditScheduler()
+        self.pool = WarmPool(self)
+        self.access = AccessControl()
+        self.fair = FairScheduler(self.access)
+        metrics.collectors.append(self.access.collect)
+        self.attachments = AttachmentIngestor()
+        self.transcripts = TranscriptStore()
+        self.resumed = False
+        self.watchdog = None
+        metrics.collectors.append(lambda: [("discord_api_total", f'kind="{k}"', v) for k, v in self.edits.stats.items()])
         print(f"INFO: Loaded session '{self.current_session}' from persistence.")
 
     def _load_last_session(self):
@@ -47,124 +2136,156 @@ class TmuxGemini:
         except:
             pass
 
+    def _load_routes(self):
+        if os.path.exists(CHANNEL_SESSIONS_FILE):
+            try:
+                with open(CHANNEL_SESSIONS_FILE, 'r') as f:
+                    return {str(k): v for k, v in json.load(f).items()}
+            except:
+                pass
+        return {}
+
+    def _save_routes(self):
+        try:
+            with open(CHANNEL_SESSIONS_FILE, 'w') as f:
+                json.dump(self.routes, f, indent=2)
+        except:
+            pass
+
+    def _load_backends(self):
+        if os.path.exists(SESSION_BACKENDS_FILE):
+            try:
+                with open(SESSION_BACKENDS_FILE, 'r') as f:
+                    return {k: v for k, v in json.load(f).items() if v in BACKENDS}
+            except:
+                pass
+        return {}
+
+    def _save_backends(self):
+        try:
+            with open(SESSION_BACKENDS_FILE, 'w') as f:
+                json.dump(self.backend_choices, f, indent=2)
+        except:
+            pass
+
     @property
     def target(self):
         return f"{self.current_session}:{self.current_window}"
 
-    def run_tmux(self, cmd_args):
+    async def _get_stream(self, session):
+        stream = self.streams.get(session)
+        if stream and stream.alive:
+            return stream
+        stream = TmuxControlStream(session)
+        if not await stream.start():
+            return None
+        self.streams[session] = stream
+        return stream
+
+    def get_session(self, target=None):
+        # "name:window" 形式のターゲットに対応するワーカーを返す（なければ作る）
+        target = target or self.target
+        if target not in self.sessions:
+            name, _, window = target.partition(":")
+            self.sessions[target] = GeminiSession(self, name, window or "0")
+        return self.sessions[target]
+
+    def target_for(self, channel):
+        # スレッド / チャンネルごとのルーティング。未設定なら既定のターゲット
+        if channel is not None and str(channel.id) in self.routes:
+            return self.routes[str(channel.id)]
+        return self.target
+
+    def session_for(self, channel):
+        return self.get_session(self.target_for(channel))
+
+    def route(self, channel, name, window="0", make_default=True):
+        # チャンネル（スレッド）を専用のセッションに割り当てる。既定のターゲットも更新
+        self.routes[str(channel.id)] = f"{name}:{window}"
+        self._save_routes()
+        if make_default:
+            self.current_session = name
+            self.current_window = window
+            self._save_last_session(name)
+        return self.get_session(f"{name}:{window}")
+
+    def set_backend(self, target, name):
+        # 次のプロンプトから使うバックエンドを切り替える（処理中のものはそのまま）
+        session = self.get_session(target)
+        session.backend = BACKENDS[name](session)
+        if name == GEMINI_BACKEND:
+            self.backend_choices.pop(session.target, None)
+        else:
+            self.backend_choices[session.target] = name
+        self._save_backends()
+        return session
+
+    async def forget(self, name):
+        # kill されたセッションのワーカー・ルーティング・ストリームを片付ける
+        for target in [t for t in self.sessions if t.partition(":")[0] == name]:
+            await self.sessions.pop(target).stop()
+        stale = [cid for cid, t in self.routes.items() if t.partition(":")[0] == name]
+        for cid in stale:
+            del self.routes[cid]
+        if stale:
+            self._save_routes()
+        stream = self.streams.pop(name, None)
+        if stream:
+            await stream.close()
+
+    async def ensure_active(self, target=None):
+        session = self.get_session(target)
+        async with session.lock:
+            with metrics.timer("gemini_ensure_active_seconds"):
+                await session.backend.ensure_active()
+
+    async def ask(self, prompt, channel, user=None):
+        # user（Discord のユーザー）ごとの上限を確認してから順番待ちに入れる
+        uid = self.access.admit(user, prompt)
         try:
-            return subprocess.check_output(["tmux"] + cmd_args, stderr=subprocess.STDOUT).decode(errors='ignore')
-        except:
-            return ""
+            return await self.session_for(channel).submit(prompt, channel, uid)
+        finally:
+            self.access.release(uid)
 
-    async def ensure_active(self):
-        check = subprocess.run(["tmux", "has-session", "-t", self.target], capture_output=True)
-        if check.returncode != 0:
-            # Create session if it doesn't exist, or a new window
-            subprocess.run(["tmux", "new-session", "-d", "-s", self.current_session, "-n", "gemini-chat"], capture_output=True)
-            await asyncio.sleep(1)
-        
-        # Ensure proper size for Gemini CLI output
-        subprocess.run(["tmux", "resize-pane", "-t", self.target, "-x", "500", "-y", "100"], capture_output=True)
-        await asyncio.sleep(1)
-        
-        # 履歴の最後の方をチェックして、Gemini のプロンプトがあるか確認
-        pane_out = self.run_tmux(["capture-pane", "-t", self.target, "-p", "-J"])
-        lines = [l.strip() for l in pane_out.splitlines() if l.strip()]
-        
-        # Gemini のプロンプト (* Type your message...) が見つからない場合は起動を試みる
-        has_gemini = any("Type your message" in l or "*" == l[:1] for l in lines[-10:])
-        
-        if not has_gemini:
-            print(f"DEBUG: Gemini prompt not found in {self.target}. Starting Gemini...")
-            # Bashの入力をクリアしてから起動
-            self.run_tmux(["send-keys", "-t", self.target, "C-c", "C-u"])
-            await asyncio.sleep(0.5)
-            self.run_tmux(["send-keys", "-t", self.target, GEMINI_CMD, "Enter"])
-            # 起動を待つ
-            await asyncio.sleep(8)
+    def start_watchdog(self):
+        if WATCHDOG_INTERVAL > 0 and (self.watchdog is None or self.watchdog.done()):
+            self.watchdog = asyncio.create_task(self._watch())
 
-    async def ask(self, prompt, channel):
-        async with channel.typing():
-            async with self.lock:
-                await self.ensure_active()
-                
-                # 入力行をクリア
-                print(f"DEBUG: Clearing line in {self.target}")
-                self.run_tmux(["send-keys", "-t", self.target, "C-c", "C-u"])
-                await asyncio.sleep(1.0) 
-                
-                # 文字を送信
-                print(f"DEBUG: Sending to tmux: {prompt}")
-                # 特殊文字による誤動作を防ぐため、文字列をそのまま送る
-                subprocess.run(["tmux", "send-keys", "-t", self.target, "-l", prompt])
-                await asyncio.sleep(0.8) 
-                
-                # 実行（Enter を確実に叩く）
-                self.run_tmux(["send-keys", "-t", self.target, "C-m"])
-                await asyncio.sleep(0.5)
-                
-                last_pane = ""
-                stable_count = 0
-                msg_handles = [] 
-                
-                # 送信直後の状態を保存
-                initial_pane = self.run_tmux(["capture-pane", "-t", self.target, "-p", "-J", "-S", "-500"])
-
-                await asyncio.sleep(2)  # 初期思考待ち
-                for i in range(200):     # 最大400秒待機
-                    await asyncio.sleep(2)
-                    pane_out = self.run_tmux(["capture-pane", "-t", self.target, "-p", "-J", "-S", "-500"])
-                    if not pane_out.strip(): continue
-                    
-                    if pane_out == last_pane:
-                        stable_count += 1
-                    else:
-                        stable_count = 0
-                        last_pane = pane_out
-                    
-                    # 変化がない場合は、初期状態（送信直後）からも変化がないかチェック
-                    # これにより、コマンドが全く受け付けられなかった場合を検知できる
-                    if stable_count > 5 and pane_out == initial_pane:
-                        print(f"DEBUG: No change detected from initial state for {prompt}. Retrying Enter...")
-                        self.run_tmux(["send-keys", "-t", self.target, "C-m"])
-                        stable_count = 0
-                        continue
-                    
-                    # 抽出（最新の状態を反映）
-                    current_responses = self._extract_latest_responses(pane_out, prompt)
-                    
-                    # リアルタイム送信/編集ロジック
-                    for idx in range(len(current_responses)):
-                        content = current_responses[idx]
-                        fixed_content = self._fix_japanese_line_breaks(content) if "✦" in content else content
-                        
-                        # まだこのインデックスのメッセージを送っていない場合
-                        if idx >= len(msg_handles):
-                            # 新規送信
-                            h = await channel.send(fixed_content[:2000])
-                            msg_handles.append(h)
-                        else:
-                            # 既存メッセージの更新（内容が変わっている場合のみ）
-                            if msg_handles[idx].content != fixed_content[:2000]:
-                                try:
-                                    await msg_handles[idx].edit(content=fixed_content[:2000])
-                                except:
-                                    pass # 削除されていた場合など
-                    
-                    # 完了判定
-                    has_prompt = any(l.strip().startswith("*") for l in pane_out.splitlines()[-5:])
-                    if has_prompt and stable_count >= 1:
-                        print(f"DEBUG: Finished because prompt detected.")
-                        break
-                    if stable_count >= 40: # 80秒停止でタイムアウト
-                        print(f"DEBUG: Finished because stable for 80s.")
-                        break
-                
-                if not msg_handles:
-                    await channel.send("（応答を抽出できませんでした）")
-                else:
-                    print(f"DEBUG: Interaction complete. Sent {len(msg_handles)} chunks.")
+    async def _watch(self):
+        # tmux バックエンドのセッションを定期的に確認し、落ちた・固まった Gemini を再起動する
+        while True:
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+            for session in list(self.sessions.values()):
+                if session.backend.name != "tmux":
+                    continue
+                try:
+                    reason = await session.health()
+                    if reason:
+                        await session.recover(reason)
+                except Exception as e:
+                    print(f"DEBUG: Watchdog check for {session.target} failed: {e}")
+
+    async def resume_interrupted(self, client):
+        # 前回の実行で応答の途中だったプロンプトを引き継ぐ。tmux のペインは再起動後も残っているので続きを読める
+        # on_ready は再接続のたびに呼ばれるので、最初の 1 回だけ
+        if self.resumed:
+            return
+        self.resumed = True
+        for pid, target, backend, channel_id, prompt, chunks in await self.transcripts.interrupted():
+            session = self.get_session(target)
+            try:
+                channel = client.get_channel(channel_id) or await client.fetch_channel(channel_id)
+            except Exception:
+                channel = None
+            if channel is None or backend != "tmux" or not await self.tmux.has_session(target):
+                # headless のプロセスは再起動で終わっているので、やり直しは利用者に任せる
+                self.transcripts.finish(pid, "interrupted")
+                if channel is not None:
+                    await channel.send(f"⚠️ 再起動で中断した応答があるよ。必要ならもう一度送ってね: {prompt[:100]}")
+                continue
+            # ワーカーや起動確認より先にロックを取り、続きを読み終えるまで次のプロンプトを待たせる
+            await session.lock.acquire()
+            asyncio.create_task(session.reattach(pid, prompt, channel, chunks))
 
     def _fix_japanese_line_breaks(self, text):
         # ターミナル幅を 500 に広げたため、基本的には改行を尊重する
@@ -172,152 +2293,11 @@ class TmuxGemini:
         return text.strip()
 
     def _extract_latest_responses(self, pane_text, user_input):
-        parts = pane_text.splitlines()
-        
-        # 🚨 ユーザーの入力をより確実にスキップする
-        start_line = 0
-        search_term = user_input.splitlines()[0][:15] if user_input.splitlines() else user_input[:15]
-        
-        # 後ろからスキャンして、最新の（一番下にある）ユーザー入力を探す
-        for idx in range(len(parts) - 1, -1, -1):
-            line = parts[idx]
-            clean_l = re.sub(r'\x1b\[[0-9;]*[mK]', '', line)
-            
-            if search_term in clean_l:
-                is_prompt = False
-                if clean_l.strip().startswith(">") or clean_l.strip().startswith("*") or ("> " + search_term in clean_l):
-                    is_prompt = True
-                
-                if is_prompt:
-                    potential_start = idx
-                    # プロンプト自体の続きをスキップし、最初の出力を探す
-                    for j in range(potential_start + 1, len(parts)):
-                        clean_j = re.sub(r'\x1b\[[0-9;]*[mK]', '', parts[j])
-                        if "✦" in clean_j or any(c in clean_j for c in "─│┌┐└┘├┤┬┴┼═║╔╗╚╝╠╣╦╩╬╭╮╯╰"):
-                            start_line = j
-                            break
-                    if start_line: break
-        
-        if not start_line: return []
-        
-        content_lines = parts[start_line:]
-        res = []
-        current_chunk = []
-        is_log_mode = False
-        
-        ui_bars = ["▀▀", "▄▄", "███", "░░░", "Type your message", "shortcuts", "skills"]
-        
-        for line in content_lines:
-            clean_line = re.sub(r'\x1b\[[0-9;]*[mK]', '', line)
-            if any(bar in clean_line for bar in ui_bars): continue
-
-            stripped_line = clean_line.lstrip()
-            # ✦ が行の先頭（または空白の後）にあるか
-            has_sparkle_at_start = stripped_line.startswith("✦")
-            # 新しいボックスの開始記号が行の先頭にあるか
-            is_new_box_at_start = stripped_line.startswith(("┌", "╭", "╔"))
-            # 罫線全般（継続判定用）
-            is_box_line = any(c in clean_line for c in "─│┌┐└┘├┤┬┴┼═║╔╗╚╝╠╣╦╩╬╭╮╯╰")
-            
-            # 1. 新しい ✦ セクションが「行の先頭で」始まった場合
-            if has_sparkle_at_start:
-                if current_chunk:
-                    text = "\n".join(current_chunk)
-                    if is_log_mode:
-                        clean = self._clean_output(text, preserve_layout=True)
-                        if clean: res.append("```\n" + clean + "\n```")
-                    else:
-                        clean = self._clean_output(text)
-                        if clean: res.append("✦ " + clean)
-                
-                sparkle_idx = clean_line.find("✦")
-                current_chunk = [clean_line[sparkle_idx+1:]]
-                is_log_mode = False
-                continue
-            
-            # 2. 新しいボックスが「行の先頭で」始まった場合
-            if is_new_box_at_start:
-                if current_chunk:
-                    text = "\n".join(current_chunk)
-                    if is_log_mode:
-                        clean = self._clean_output(text, preserve_layout=True)
-                        if clean: res.append("```\n" + clean + "\n```")
-                    else:
-                        clean = self._clean_output(text)
-                        if clean: res.append("✦ " + clean)
-                current_chunk = [line]
-                is_log_mode = True
-                continue
-            
-            # 3. ボックス（ログ）継続判定
-            if is_box_line:
-                if not is_log_mode:
-                    if current_chunk:
-                        text = "\n".join(current_chunk)
-                        clean = self._clean_output(text)
-                        if clean: res.append("✦ " + clean)
-                    current_chunk = [line]
-                    is_log_mode = True
-                else:
-                    current_chunk.append(line)
-                continue
-            
-            # 4. ボックスの終了判定（罫線がない行が来た場合）
-            if is_log_mode:
-                # ログモード中に罫線がない行が来たら、即座にログを閉じる
-                if current_chunk:
-                    text = "\n".join(current_chunk)
-                    clean = self._clean_output(text, preserve_layout=True)
-                    if clean: res.append("```\n" + clean + "\n```")
-                current_chunk = [line]
-                is_log_mode = False
-                continue
-
-            # 5. 通常のテキスト
-            # ✦ がなくても、プロンプト後の最初のテキストセクションとして扱う
-            current_chunk.append(line)
-            
-        if current_chunk:
-            text = "\n".join(current_chunk)
-            if is_log_mode:
-                clean = self._clean_output(text, preserve_layout=True)
-                if clean: res.append("```\n" + clean + "\n```")
-            else:
-                clean = self._clean_output(text)
-                # ✦ が含まれていないプレーンテキスト（/helpなど）の場合は、コードブロックで囲うと見やすい
-                if clean:
-                    if "✦" not in text:
-                        res.append("```\n" + clean + "\n```")
-                    else:
-                        res.append("✦ " + clean)
-                
-        return [r for r in res if r.strip()]
+        # ステートレス版（1 回きりの解析）。ストリーミング中は ResponseParser を使う
+        return ResponseParser(user_input).feed_all(pane_text)
 
     def _clean_output(self, text, preserve_layout=False):
-        # UI ornaments and box characters to strip
-        ignore = ["Type your message", "Press Ctrl+C", "no sandbox", "Update available", "shortcuts", "YOLO", "skills", "file |", "▀▀", "▄▄", "███", "░░░"]
-        
-        lines = text.splitlines()
-        result = []
-        for l in lines:
-            if any(p in l for p in ignore): continue
-            
-            # Remove ANSI color codes
-            clean_l = re.sub(r'\x1b\[[0-9;]*[mK]', '', l)
-            
-            # 🚨 枠線（罫線）を徹底的に消す！（丸い角 ╭╮╯╰ も追加！）
-            clean_l = re.sub(r'[─│┌┐└┘├┤┬┴┼═║╔╗╚╝╠╣╦╩╬╭╮╯╰]', '', clean_l)
-            
-            if not preserve_layout:
-                clean_l = clean_l.strip()
-            else:
-                # ログモードの時は、右側の空白だけ消してインデントは守る
-                clean_l = clean_l.rstrip()
-                
-            if clean_l.strip(): # 中身がある行だけを採用
-                result.append(clean_l)
-        
-        return "\n".join(result).strip()
+        return clean_lines(text.splitlines(), preserve_layout)
 
 tmux_gemini = TmuxGemini()
 
@@ -325,96 +2305,258 @@ class GeminiBot(commands.Bot):
     def __init__(self):
         super().__init__(command_prefix="!", intents=intents)
 
+    def _tree_fingerprint(self, guild):
+        # コマンド定義・同期先・アプリが同じなら同期し直す必要はない
+        commands = sorted((c.to_dict(self.tree) for c in self.tree.get_commands(guild=guild)), key=lambda c: c["name"])
+        payload = json.dumps([self.application_id, guild.id if guild else None, commands], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def sync_commands(self):
+        guild = discord.Object(id=int(SYNC_GUILD_ID)) if SYNC_GUILD_ID else None
+        if guild:
+            self.tree.copy_global_to(guild=guild)
+        fingerprint = self._tree_fingerprint(guild)
+        try:
+            with open(COMMAND_TREE_FILE, 'r') as f:
+                if f.read().strip() == fingerprint:
+                    print("Slash commands unchanged, skipping sync.")
+                    return
+        except OSError:
+            pass
+        with metrics.timer("discord_tree_sync_seconds"):
+            await self.tree.sync(guild=guild)
+        print(f"Synced slash commands{f' to guild {SYNC_GUILD_ID}' if guild else ''}.")
+        try:
+            with open(COMMAND_TREE_FILE, 'w') as f:
+                f.write(fingerprint)
+        except OSError:
+            pass
+
     async def setup_hook(self):
-        await self.tree.sync()
-        print("Synced slash commands.")
+        tmux_gemini.transcripts.start()
+        await self.sync_commands()
+        if METRICS_PORT:
+            await metrics.serve(METRICS_HOST, METRICS_PORT)
+
+    async def close(self):
+        # 書き込みスレッドの終了を待つ間もイベントループは止めない
+        await asyncio.to_thread(tmux_gemini.transcripts.close)
+        await tmux_gemini.attachments.close()
+        await super().close()
 
 bot = GeminiBot()
 
+async def warmup():
+    # Gemini の起動確認とプールの準備。メッセージの受付はこれを待たない（届いたプロンプトはロックで順番待ちになる）
+    try:
+        await tmux_gemini.ensure_active()
+    except Exception as e:
+        print(f"DEBUG: Warmup failed: {e}")
+    tmux_gemini.pool.start()
+    tmux_gemini.start_watchdog()
+    print("Warmup finished.")
+
+warmup_task = None
+
 @bot.event
 async def on_ready():
+    global warmup_task
     print(f'Logged in as {bot.user.name}')
-    await tmux_gemini.ensure_active()
+    await tmux_gemini.resume_interrupted(bot)
+    # on_ready は再接続のたびに呼ばれるので、起動済みなら何もしない
+    if warmup_task is None:
+        warmup_task = asyncio.create_task(warmup())
     print('Ready! (Slash Commands Active)')
 
 def is_owner():
     def predicate(interaction: discord.Interaction):
-        return MY_DISCORD_ID and str(interaction.user.id) == str(MY_DISCORD_ID)
+        return AccessControl.is_owner(interaction.user)
+    return app_commands.check(predicate)
+
+def is_allowed():
+    # 許可リストのユーザー・ロールも使えるコマンド
+    def predicate(interaction: discord.Interaction):
+        return tmux_gemini.access.is_allowed(interaction.user)
     return app_commands.check(predicate)
 
 @bot.tree.command(name="sessions", description="稼働中の tmux セッション一覧を表示するよ")
 @is_owner()
 async def sessions(interaction: discord.Interaction):
-    try:
-        out = subprocess.check_output(["tmux", "ls"], stderr=subprocess.STDOUT).decode(errors='ignore')
-        if not out.strip():
-            await interaction.response.send_message("ℹ️ 稼働中の tmux セッションはありません。")
-        else:
-            await interaction.response.send_message(f"📋 **稼働中のセッション一覧:**\n```\n{out.strip()}\n```")
-    except subprocess.CalledProcessError:
+    res = await tmux_gemini.tmux.list_sessions()
+    if not res.ok:
         await interaction.response.send_message("⚠️ tmux セッションが見つかりませんでした。")
+    elif not res.stdout.strip():
+        await interaction.response.send_message("ℹ️ 稼働中の tmux セッションはありません。")
+    else:
+        # 待機中のプール用ペインは一覧から外して件数だけ出す
+        out = "\n".join(l for l in res.stdout.strip().splitlines() if not l.startswith(WARM_POOL_PREFIX))
+        msg = f"📋 **稼働中のセッション一覧:**\n```\n{out or '(なし)'}\n```"
+        if tmux_gemini.pool.size > 0:
+            msg += f"\n🔥 起動済みの予備ペイン: {len(tmux_gemini.pool.ready)}/{tmux_gemini.pool.size}"
+        await interaction.response.send_message(msg)
 
 @bot.tree.command(name="session_new", description="新しい tmux セッションを作成して Gemini を起動するよ")
 @app_commands.describe(name="新しいセッション名")
 @is_owner()
 async def session_new(interaction: discord.Interaction, name: str):
     await interaction.response.defer()
-    check = subprocess.run(["tmux", "has-session", "-t", name], capture_output=True)
-    if check.returncode == 0:
+    if await tmux_gemini.tmux.has_session(name):
         await interaction.followup.send(f"⚠️ セッション `{name}` は既に存在しているよ。")
         return
     
-    subprocess.run(["tmux", "new-session", "-d", "-s", name, "-n", "gemini-chat"], capture_output=True)
-    await asyncio.sleep(1)
-    subprocess.run(["tmux", "send-keys", "-t", f"{name}:0", GEMINI_CMD, "Enter"], capture_output=True)
+    # 予備ペインがあれば即座に引き継ぎ、なければその場で起動する
+    if await tmux_gemini.pool.claim(name):
+        sess = tmux_gemini.route(interaction.channel, name)
+        # 引き継いだペインもサイズ合わせと Gemini が動いているかの確認は通す
+        await tmux_gemini.ensure_active(sess.target)
+        await interaction.followup.send(f"🚀 起動済みの Gemini を `{name}` として割り当てたよ！このチャンネルのターゲットも切り替えたよ。")
+        return
     
-    tmux_gemini.current_session = name
-    tmux_gemini.current_window = "0"
-    tmux_gemini._save_last_session(name)
-    await interaction.followup.send(f"🚀 新しいセッション `{name}` を作成して、Gemini を起動したよ！ターゲットも切り替えたよ。")
+    res = await tmux_gemini.tmux.new_session(name)
+    if not res.ok:
+        await interaction.followup.send(f"⚠️ セッション `{name}` を作成できなかったよ: `{res.stderr.strip() or 'timeout'}`")
+        return
+    sess = tmux_gemini.route(interaction.channel, name)
+    await tmux_gemini.ensure_active(sess.target)
+    await interaction.followup.send(f"🚀 新しいセッション `{name}` を作成して、Gemini を起動したよ！このチャンネルのターゲットも切り替えたよ。")
 
 @bot.tree.command(name="session_kill", description="指定した tmux セッションを終了させるよ")
 @app_commands.describe(name="終了させるセッション名")
 @is_owner()
 async def session_kill(interaction: discord.Interaction, name: str):
-    check = subprocess.run(["tmux", "has-session", "-t", name], capture_output=True)
-    if check.returncode != 0:
+    if not await tmux_gemini.tmux.has_session(name):
         await interaction.response.send_message(f"⚠️ セッション `{name}` は見つからなかったよ。")
         return
     
-    subprocess.run(["tmux", "kill-session", "-t", name], capture_output=True)
+    await tmux_gemini.tmux.kill_session(name)
+    await tmux_gemini.forget(name)
     await interaction.response.send_message(f"💥 セッション `{name}` を終了させたよ。")
 
 @bot.tree.command(name="status", description="今のセッション情報を確認するよ")
-@is_owner()
+@is_allowed()
 async def status(interaction: discord.Interaction):
-    await interaction.response.send_message(f"ℹ️ 現在のターゲット: `{tmux_gemini.target}`")
+    lines = [f"ℹ️ このチャンネルのターゲット: `{tmux_gemini.target_for(interaction.channel)}`",
+             f"既定のターゲット: `{tmux_gemini.target}`"]
+    for target, sess in tmux_gemini.sessions.items():
+        state = "🔄 応答中" if sess.busy else "💤 待機中"
+        lines.append(f"- `{target}` [{sess.backend.name}]: {state} (待ち {len(sess.jobs)} 件)")
+    lines.append(f"📨 Discord API: {tmux_gemini.edits.summary()}")
+    await interaction.response.send_message("\n".join(lines))
 
-@bot.tree.command(name="session", description="ターゲットにする tmux セッションを切り替えるよ")
+@bot.tree.command(name="session", description="このチャンネル（スレッド）のターゲット tmux セッションを切り替えるよ")
 @app_commands.describe(name="セッション名", window="ウィンドウ番号 (省略可)")
 @is_owner()
 async def session(interaction: discord.Interaction, name: str, window: str = "0"):
-    tmux_gemini.current_session = name
-    tmux_gemini.current_window = window
-    tmux_gemini._save_last_session(name)
-    await interaction.response.send_message(f"✅ ターゲットを `{tmux_gemini.target}` に切り替えたよ！")
-    await tmux_gemini.ensure_active()
+    sess = tmux_gemini.route(interaction.channel, name, window)
+    await interaction.response.send_message(f"✅ このチャンネルのターゲットを `{sess.target}` に切り替えたよ！")
+    await tmux_gemini.ensure_active(sess.target)
+
+@bot.tree.command(name="backend", description="このチャンネルのセッションで応答を受け取る方法を切り替えるよ")
+@app_commands.describe(name="tmux: 画面を読み取る / headless: gemini -p の stream-json を読む")
+@app_commands.choices(name=[app_commands.Choice(name=n, value=n) for n in BACKENDS])
+@is_owner()
+async def backend(interaction: discord.Interaction, name: str):
+    sess = tmux_gemini.set_backend(tmux_gemini.target_for(interaction.channel), name)
+    await interaction.response.send_message(f"✅ `{sess.target}` のバックエンドを `{name}` に切り替えたよ！")
+    await tmux_gemini.ensure_active(sess.target)
+
+@bot.tree.command(name="queue", description="このチャンネルのセッションの順番待ちを表示するよ")
+@is_allowed()
+async def queue(interaction: discord.Interaction):
+    sess = tmux_gemini.session_for(interaction.channel)
+    if not sess.current and not sess.jobs:
+        await interaction.response.send_message(f"ℹ️ `{sess.target}` に順番待ちはないよ。")
+        return
+    names = tmux_gemini.access.names
+    who = lambda job: f" ({names.get(job.user_id, job.user_id)})" if job.user_id else ""
+    lines = [f"📋 **`{sess.target}` の順番待ち:**"]
+    if sess.current:
+        lines.append(f"▶️ 処理中: {sess.current.preview}{who(sess.current)}")
+    for i, job in enumerate(tmux_gemini.fair.order(sess.jobs), 1):
+        lines.append(f"{i}. {job.preview}{who(job)}")
+    await interaction.response.send_message("\n".join(lines))
+
+@bot.tree.command(name="cancel", description="このチャンネルの処理中・順番待ちのプロンプトを取り消すよ")
+@app_commands.describe(all="このセッションの全チャンネル分を取り消す（管理者のみ）")
+@is_allowed()
+async def cancel(interaction: discord.Interaction, all: bool = False):
+    sess = tmux_gemini.session_for(interaction.channel)
+    # 管理者以外は自分のプロンプトだけ
+    owner = AccessControl.is_owner(interaction.user)
+    if all and not owner:
+        await interaction.response.send_message("⚠️ `all` は管理者だけが使えるよ。")
+        return
+    dropped, stopped = await sess.cancel(None if all else interaction.channel, None if owner else str(interaction.user.id))
+    if not dropped and not stopped:
+        await interaction.response.send_message("ℹ️ 取り消すプロンプトはなかったよ。")
+        return
+    parts = []
+    if stopped:
+        parts.append("処理中の応答を止めた")
+    if dropped:
+        parts.append(f"順番待ち {dropped} 件を取り消した")
+    await interaction.response.send_message(f"🚫 {'、'.join(parts)}よ。")
+
+@bot.tree.command(name="usage", description="ユーザーごとの利用状況を表示するよ")
+@is_allowed()
+async def usage(interaction: discord.Interaction):
+    access = tmux_gemini.access
+    # 管理者は全員分、それ以外は自分の分だけ
+    uids = list(access.usage) if AccessControl.is_owner(interaction.user) else [str(interaction.user.id)]
+    lines = [f"{'user':<20} {'prompts':>7} {'inflight':>8} {'busy(s)':>8} {'wait(s)':>8} {'rejected':>8}"]
+    for uid in uids:
+        u = access.usage.get(uid, collections.Counter())
+        rejected = sum(v for k, v in u.items() if k.startswith("rejected_"))
+        lines.append(f"{access.names.get(uid, uid)[:20]:<20} {u['prompts']:>7} {access.inflight[uid]:>8} "
+                     f"{u['busy_seconds']:>8.1f} {u['queue_seconds']:>8.1f} {rejected:>8}")
+    await interaction.response.send_message(f"👥 **利用状況:**\n```\n{chr(10).join(lines)[:1900]}\n```")
+
+@bot.tree.command(name="metrics", description="処理時間の内訳（tmux・Gemini・Discord）を表示するよ")
+@is_owner()
+async def metrics_cmd(interaction: discord.Interaction):
+    await interaction.response.send_message(f"📊 **メトリクス (秒):**\n```\n{metrics.summary()[:1900]}\n```")
+
+history = app_commands.Group(name="history", description="これまでのやり取りを扱うよ")
+
+@history.command(name="search", description="これまでのプロンプトと応答を全文検索するよ")
+@app_commands.describe(query="検索する言葉（空白区切りで AND）")
+@is_owner()
+async def history_search(interaction: discord.Interaction, query: str):
+    rows = await tmux_gemini.transcripts.search(query)
+    if not rows:
+        await interaction.response.send_message(f"🔍 `{query}` は見つからなかったよ。")
+        return
+    guild = interaction.guild.id if interaction.guild else "@me"
+    lines = [f"🔍 **`{query}` の検索結果:**"]
+    for pid, target, channel_id, created, prompt, snippet, message_id in rows:
+        link = f" [→](https://discord.com/channels/{guild}/{channel_id}/{message_id})" if message_id else ""
+        lines.append(f"- <t:{int(created)}:R> `{target}` **{prompt[:60]}**{link}\n  {snippet.replace(chr(10), ' ')[:200]}")
+    await interaction.response.send_message("\n".join(lines)[:2000])
+
+bot.tree.add_command(history)
 
 @bot.tree.command(name="cmd", description="Gemini CLI にコマンドを送信するよ (自動で / が付きます)")
 @app_commands.describe(command="送信するコマンド (例: reset, help, file gemini.md)")
-@is_owner()
+@is_allowed()
 async def cmd(interaction: discord.Interaction, command: str):
     # 頭に / がなければ付ける
     gemini_cmd = command if command.startswith("/") else f"/{command}"
     await interaction.response.send_message(f"⌨️ Gemini コマンド実行: `{gemini_cmd}`")
-    await tmux_gemini.ask(gemini_cmd, interaction.channel)
+    try:
+        await tmux_gemini.ask(gemini_cmd, interaction.channel, interaction.user)
+    except QuotaExceededError as e:
+        await interaction.followup.send(f"⚠️ {e}")
+    except QueueFullError:
+        await interaction.followup.send("⚠️ 順番待ちがいっぱいだよ。少し待ってからもう一度送ってね。")
+    except GeminiUnavailableError:
+        await interaction.followup.send("⚠️ Gemini が応答しなくなったので再起動したよ。もう一度送ってね。")
 
 @bot.event
 async def on_message(message):
     if message.author == bot.user: return
     
-    # 🚨 セキュリティガード：自分以外のユーザーからのメッセージは無視する
-    if MY_DISCORD_ID and str(message.author.id) != str(MY_DISCORD_ID):
+    # 🚨 セキュリティガード：許可リスト（自分・ALLOWED_USER_IDS・ALLOWED_ROLE_IDS）以外のユーザーからのメッセージは無視する
+    if not tmux_gemini.access.is_allowed(message.author):
         print(f"SECURITY: Ignored message from unauthorized user {message.author} (ID: {message.author.id})")
         return
 
@@ -424,11 +2566,20 @@ async def on_message(message):
     is_mentioned = bot.user.mentioned_in(message)
     target_channel_id = os.getenv("DISCORD_CHANNEL_ID")
     is_target_channel = str(message.channel.id) == str(target_channel_id)
+    # /session でセッションを割り当てたチャンネル・スレッドも対象
+    is_routed = str(message.channel.id) in tmux_gemini.routes
+    # 対象チャンネルから生えた新しいスレッドには専用のセッションを割り当てる
+    is_new_thread = (THREAD_SESSIONS and not is_routed and isinstance(message.channel, discord.Thread)
+                     and str(message.channel.parent_id) == str(target_channel_id))
+    
+    if not (is_dm or is_mentioned or is_target_channel or is_routed or is_new_thread): return
     
-    if not (is_dm or is_mentioned or is_target_channel): return
+    if is_new_thread:
+        sess = tmux_gemini.route(message.channel, f"thread-{message.channel.id}", make_default=False)
+        print(f"DEBUG: New thread {message.channel.id} routed to {sess.target}")
     
     content = message.content.replace(f"<@{bot.user.id}>", "").replace(f"<@!{bot.user.id}>", "").strip()
-    if not content: return
+    if not content and not message.attachments: return
     
     # ✦ cmd xxx 形式のコマンド処理
     if content.lower().startswith("cmd "):
@@ -436,10 +2587,31 @@ async def on_message(message):
         if cmd_part:
             gemini_cmd = cmd_part if cmd_part.startswith("/") else f"/{cmd_part}"
             print(f"DEBUG: Command detected in message, sending: {gemini_cmd}")
-            await tmux_gemini.ask(gemini_cmd, message.channel)
+            content = gemini_cmd
+
+    # 添付ファイルは作業ディレクトリに保存して、プロンプトからは @file で参照する
+    if message.attachments:
+        # 上限を超えている人の添付はダウンロードしない
+        try:
+            tmux_gemini.access.check(message.author, content)
+        except QuotaExceededError as e:
+            await message.reply(f"⚠️ {e}")
             return
+        refs, skipped = await tmux_gemini.attachments.ingest(message.attachments, tmux_gemini.session_for(message.channel))
+        if skipped:
+            await message.reply("⚠️ 次の添付ファイルは渡せなかったよ: " + ", ".join(skipped))
+        if refs:
+            content = (content + "\n\n" if content else "") + " ".join(refs)
+        if not content: return
 
-    await tmux_gemini.ask(content, message.channel)
+    try:
+        await tmux_gemini.ask(content, message.channel, message.author)
+    except QuotaExceededError as e:
+        await message.reply(f"⚠️ {e}")
+    except QueueFullError:
+        await message.reply("⚠️ 順番待ちがいっぱいだよ。少し待ってからもう一度送ってね。")
+    except GeminiUnavailableError:
+        await message.reply("⚠️ Gemini が応答しなくなったので再起動したよ。もう一度送ってね。")
 
 def main():
     if not DISCORD_TOKEN:
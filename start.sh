@@ -19,7 +19,6 @@ fi
 SESSION_NAME="${SAVED_SESSION:-${TMUX_SESSION_NAME:-gemini-bot}}"
 VENV_PATH="${VENV_PATH:-/home/ubuntu/bot_venv}"
 BOT_SCRIPT="./main.py"
-GEMINI_CMD="${GEMINI_EXECUTABLE_PATH:-gemini}"
 
 echo "Starting Gemini Discord Bot in directory: $SCRIPT_DIR"
 
@@ -27,13 +26,7 @@ echo "Starting Gemini Discord Bot in directory: $SCRIPT_DIR"
 if ! tmux has-session -t "$SESSION_NAME" 2>/dev/null; then
     echo "Creating new tmux session: $SESSION_NAME"
     tmux new-session -d -s "$SESSION_NAME" -n "gemini-chat"
-    sleep 1
-    # Initialize Gemini CLI
-    tmux send-keys -t "$SESSION_NAME:0" -l "$GEMINI_CMD --y"
-    tmux send-keys -t "$SESSION_NAME:0" Enter
-    echo "Waiting for Gemini to initialize..."
-    # We use a simple sleep here for the initial setup
-    sleep 5
+    # Gemini CLI はボットが起動後に裏で立ち上げる（プロンプトが出るまで待つのもボット側）
 else
     echo "Reusing existing tmux session: $SESSION_NAME"
 fi
@@ -48,7 +41,11 @@ if [ -f "$PID_FILE" ]; then
     if ps -p "$OLD_PID" > /dev/null 2>&1; then
         echo "Stopping old process (PID: $OLD_PID)..."
         kill "$OLD_PID" || kill -9 "$OLD_PID"
-        sleep 1
+        # 終了したらすぐ次へ（最大 5 秒）
+        for _ in $(seq 50); do
+            ps -p "$OLD_PID" > /dev/null 2>&1 || break
+            sleep 0.1
+        done
     fi
 fi
 